@@ -0,0 +1,35 @@
+"""NOTIFY the created and finished subscriptions
+
+Revision ID: 2af4dd8c0498
+Revises: e00cda069185
+Create Date: 2026-10-17 20:02:47.530114
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2af4dd8c0498'
+down_revision = 'e00cda069185'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("""
+    CREATE OR REPLACE FUNCTION notify_subscriptions() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('subscriptions', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+    CREATE TRIGGER subscriptions_notify AFTER INSERT OR UPDATE OF finished_at ON subscriptions
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_subscriptions();
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER subscriptions_notify ON subscriptions")
+    op.execute("DROP FUNCTION notify_subscriptions()")
@@ -0,0 +1,24 @@
+"""Lease the notification claims with claimed_at
+
+Revision ID: 3c81f0d95a27
+Revises: 5ef37b558af9
+Create Date: 2026-10-18 14:27:05.631942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c81f0d95a27'
+down_revision = '5ef37b558af9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('notifications', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('notifications', 'claimed_at')
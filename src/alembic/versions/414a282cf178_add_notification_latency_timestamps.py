@@ -0,0 +1,28 @@
+"""Add notification latency timestamps
+
+Revision ID: 414a282cf178
+Revises: 495ff4506c23
+Create Date: 2026-10-17 19:30:12.604211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '414a282cf178'
+down_revision = '495ff4506c23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('notifications', sa.Column('event_at', sa.DateTime(), nullable=True))
+    op.add_column('notifications', sa.Column('received_at', sa.DateTime(), nullable=True))
+    op.add_column('notifications', sa.Column('detected_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('notifications', 'detected_at')
+    op.drop_column('notifications', 'received_at')
+    op.drop_column('notifications', 'event_at')
@@ -0,0 +1,30 @@
+"""Create ingestion_workers table
+
+Revision ID: 495ff4506c23
+Revises: 0cea7379ebb2
+Create Date: 2026-10-17 10:12:40.182541
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '495ff4506c23'
+down_revision = '0cea7379ebb2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('ingestion_workers',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_heartbeat', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('ingestion_workers')
@@ -0,0 +1,50 @@
+"""Track the subscription changes with updated_at
+
+Revision ID: 5ef37b558af9
+Revises: def9e53f6e61
+Create Date: 2026-10-18 09:12:40.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5ef37b558af9'
+down_revision = 'def9e53f6e61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('subscriptions', sa.Column('updated_at', sa.DateTime(), nullable=True,
+                                             server_default=sa.text("timezone('utc', now())")))
+    op.execute("UPDATE subscriptions SET updated_at = COALESCE(finished_at, created_at)")
+    op.alter_column('subscriptions', 'updated_at', nullable=False)
+    op.execute("""
+    CREATE OR REPLACE FUNCTION touch_subscriptions() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at := timezone('utc', now());
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+    CREATE TRIGGER subscriptions_updated_at BEFORE INSERT OR UPDATE OF finished_at ON subscriptions
+    FOR EACH ROW EXECUTE FUNCTION touch_subscriptions();
+    """)
+
+    # The delta of the ingestion mirror no longer reads created_at and finished_at
+    op.drop_index('ix_subscriptions_finished_at', table_name='subscriptions')
+    op.drop_index('ix_subscriptions_created_at', table_name='subscriptions')
+    op.create_index('ix_subscriptions_updated_at', 'subscriptions', ['updated_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_subscriptions_updated_at', table_name='subscriptions')
+    op.create_index('ix_subscriptions_created_at', 'subscriptions', ['created_at'])
+    op.create_index('ix_subscriptions_finished_at', 'subscriptions', ['finished_at'])
+
+    op.execute("DROP TRIGGER subscriptions_updated_at ON subscriptions")
+    op.execute("DROP FUNCTION touch_subscriptions()")
+    op.drop_column('subscriptions', 'updated_at')
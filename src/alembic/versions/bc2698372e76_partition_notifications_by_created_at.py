@@ -0,0 +1,109 @@
+"""Partition notifications by created_at
+
+Revision ID: bc2698372e76
+Revises: c636d3f3a80b
+Create Date: 2026-10-17 21:38:12.906217
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'bc2698372e76'
+down_revision = 'c636d3f3a80b'
+branch_labels = None
+depends_on = None
+
+COLUMNS = "id, subscription_id, symbol, message, order_ref, created_at, finished_at, event_at, received_at, detected_at"
+
+
+def upgrade() -> None:
+    # Put the current table aside, its constraint and index names are taken by the new one
+    op.execute("DROP TRIGGER notifications_notify ON notifications")
+    op.execute("DROP INDEX ix_notifications_pending")
+    op.execute("ALTER TABLE notifications RENAME TO notifications_unpartitioned")
+    op.execute("ALTER TABLE notifications_unpartitioned RENAME CONSTRAINT notifications_pkey "
+               "TO notifications_unpartitioned_pkey")
+    op.execute("UPDATE notifications_unpartitioned SET created_at = timezone('utc', now()) WHERE created_at IS NULL")
+
+    op.execute("""
+    CREATE TABLE notifications (
+        id VARCHAR(36) NOT NULL,
+        subscription_id VARCHAR(36) NOT NULL,
+        symbol VARCHAR NOT NULL,
+        message VARCHAR NOT NULL,
+        order_ref INTEGER NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        finished_at TIMESTAMP WITHOUT TIME ZONE,
+        event_at TIMESTAMP WITHOUT TIME ZONE,
+        received_at TIMESTAMP WITHOUT TIME ZONE,
+        detected_at TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("CREATE TABLE notifications_default PARTITION OF notifications DEFAULT")
+    # A partition per day of the current rows, up to the partitions the retention job keeps ahead
+    op.execute("""
+    DO $$
+    DECLARE
+        day date;
+    BEGIN
+        FOR day IN SELECT generate_series(
+            COALESCE((SELECT min(created_at) FROM notifications_unpartitioned), timezone('utc', now()))::date,
+            timezone('utc', now())::date + 2,
+            interval '1 day'
+        )::date LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF notifications FOR VALUES FROM (%L) TO (%L)',
+                           'notifications_p' || to_char(day, 'YYYYMMDD'), day, day + 1);
+        END LOOP;
+    END;
+    $$
+    """)
+    op.execute(f"INSERT INTO notifications ({COLUMNS}) SELECT {COLUMNS} FROM notifications_unpartitioned")
+    op.execute("DROP TABLE notifications_unpartitioned")
+    # Once the name is free
+    op.execute("ALTER TABLE notifications ADD CONSTRAINT notifications_subscription_id_fkey "
+               "FOREIGN KEY (subscription_id) REFERENCES subscriptions (id)")
+
+    op.execute("CREATE INDEX ix_notifications_pending ON notifications (subscription_id, created_at) "
+               "WHERE finished_at IS NULL")
+    op.execute("""
+    CREATE TRIGGER notifications_notify AFTER INSERT ON notifications
+    REFERENCING NEW TABLE AS inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_notifications();
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER notifications_notify ON notifications")
+    op.execute("ALTER TABLE notifications RENAME TO notifications_partitioned")
+    op.execute("ALTER TABLE notifications_partitioned RENAME CONSTRAINT notifications_pkey "
+               "TO notifications_partitioned_pkey")
+    op.execute("ALTER INDEX ix_notifications_pending RENAME TO ix_notifications_partitioned_pending")
+
+    op.execute("""
+    CREATE TABLE notifications (
+        id VARCHAR(36) NOT NULL PRIMARY KEY,
+        subscription_id VARCHAR(36) NOT NULL,
+        symbol VARCHAR NOT NULL,
+        message VARCHAR NOT NULL,
+        order_ref INTEGER NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE,
+        finished_at TIMESTAMP WITHOUT TIME ZONE,
+        event_at TIMESTAMP WITHOUT TIME ZONE,
+        received_at TIMESTAMP WITHOUT TIME ZONE,
+        detected_at TIMESTAMP WITHOUT TIME ZONE
+    )
+    """)
+    op.execute(f"INSERT INTO notifications ({COLUMNS}) SELECT {COLUMNS} FROM notifications_partitioned")
+    op.execute("DROP TABLE notifications_partitioned")
+    op.execute("ALTER TABLE notifications ADD CONSTRAINT notifications_subscription_id_fkey "
+               "FOREIGN KEY (subscription_id) REFERENCES subscriptions (id)")
+
+    op.execute("CREATE INDEX ix_notifications_pending ON notifications (subscription_id, created_at) "
+               "WHERE finished_at IS NULL")
+    op.execute("""
+    CREATE TRIGGER notifications_notify AFTER INSERT ON notifications
+    REFERENCING NEW TABLE AS inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_notifications();
+    """)
@@ -0,0 +1,38 @@
+"""Add indexes for the hot queries
+
+Revision ID: c636d3f3a80b
+Revises: 2af4dd8c0498
+Create Date: 2026-10-17 21:10:36.402917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c636d3f3a80b'
+down_revision = '2af4dd8c0498'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_subscriptions_live_symbol', 'subscriptions', ['symbol', 'last_heartbeat'],
+                    postgresql_where=sa.text('finished_at IS NULL'))
+    op.create_index('ix_subscriptions_live_connection', 'subscriptions', ['connection_id'],
+                    postgresql_where=sa.text('finished_at IS NULL'))
+    op.create_index('ix_subscriptions_created_at', 'subscriptions', ['created_at'])
+    op.create_index('ix_subscriptions_finished_at', 'subscriptions', ['finished_at'])
+    op.create_index('ix_subscriptions_last_heartbeat', 'subscriptions', ['last_heartbeat'],
+                    postgresql_where=sa.text('finished_at IS NULL'))
+    op.create_index('ix_notifications_pending', 'notifications', ['subscription_id', 'created_at'],
+                    postgresql_where=sa.text('finished_at IS NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_notifications_pending', table_name='notifications')
+    op.drop_index('ix_subscriptions_last_heartbeat', table_name='subscriptions')
+    op.drop_index('ix_subscriptions_finished_at', table_name='subscriptions')
+    op.drop_index('ix_subscriptions_created_at', table_name='subscriptions')
+    op.drop_index('ix_subscriptions_live_connection', table_name='subscriptions')
+    op.drop_index('ix_subscriptions_live_symbol', table_name='subscriptions')
@@ -0,0 +1,91 @@
+"""Use BIGINT ids for connections, subscriptions and notifications
+
+Revision ID: def9e53f6e61
+Revises: bc2698372e76
+Create Date: 2026-10-17 22:05:51.713820
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'def9e53f6e61'
+down_revision = 'bc2698372e76'
+branch_labels = None
+depends_on = None
+
+# Column of the id, by table, and the foreign keys
+IDS = [("connections", "id"), ("subscriptions", "id"), ("subscriptions", "connection_id"),
+       ("notifications", "id"), ("notifications", "subscription_id")]
+SEQUENCES = ["connections", "subscriptions", "notifications"]
+FOREIGN_KEYS = [("subscriptions", "connection_id", "connections"),
+                ("notifications", "subscription_id", "subscriptions")]
+
+
+def drop_foreign_keys():
+    for table, column, _ in FOREIGN_KEYS:
+        op.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_{column}_fkey")
+
+
+def add_foreign_keys():
+    for table, column, referred in FOREIGN_KEYS:
+        op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey "
+                   f"FOREIGN KEY ({column}) REFERENCES {referred} (id)")
+
+
+def notify_notifications(connection_id: str):
+    op.execute(f"""
+    CREATE OR REPLACE FUNCTION notify_notifications() RETURNS trigger AS $$
+    DECLARE
+        payload text;
+    BEGIN
+        SELECT string_agg(DISTINCT {connection_id}, ',') INTO payload
+        FROM inserted i JOIN subscriptions s ON s.id = i.subscription_id;
+        IF payload IS NOT NULL THEN
+            IF length(payload) > 7900 THEN
+                payload := '';
+            END IF;
+            PERFORM pg_notify('notifications', payload);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+
+def upgrade() -> None:
+    drop_foreign_keys()
+    # Duplicates of the primary keys, only on the databases created from the models
+    op.execute("ALTER TABLE connections DROP CONSTRAINT IF EXISTS connections_id_key")
+    op.execute("ALTER TABLE subscriptions DROP CONSTRAINT IF EXISTS subscriptions_id_key")
+
+    # The ids were uuid4().hex[:8]: the same 32 bits as a number keep the references, and the ids the clients know
+    for table, column in IDS:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT "
+                   f"USING ('x' || lpad({column}, 16, '0'))::bit(64)::bigint")
+    # As BIGSERIAL does, starting after the converted ids
+    for table in SEQUENCES:
+        op.execute(f"CREATE SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        op.execute(f"SELECT setval('{table}_id_seq', COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{table}_id_seq')")
+    add_foreign_keys()
+
+    op.execute("DROP INDEX ix_subscriptions_live_connection")
+    op.execute("CREATE INDEX ix_subscriptions_live_connection ON subscriptions (connection_id, last_heartbeat) "
+               "WHERE finished_at IS NULL")
+    notify_notifications("s.connection_id::text")
+
+
+def downgrade() -> None:
+    drop_foreign_keys()
+    for table in SEQUENCES:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id DROP DEFAULT")
+        op.execute(f"DROP SEQUENCE {table}_id_seq")
+    for table, column in IDS:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE VARCHAR(36) USING lpad(to_hex({column}), 8, '0')")
+    add_foreign_keys()
+
+    op.execute("DROP INDEX ix_subscriptions_live_connection")
+    op.execute("CREATE INDEX ix_subscriptions_live_connection ON subscriptions (connection_id) "
+               "WHERE finished_at IS NULL")
+    notify_notifications("s.connection_id")
@@ -0,0 +1,45 @@
+"""NOTIFY the inserted notifications
+
+Revision ID: e00cda069185
+Revises: 414a282cf178
+Create Date: 2026-10-17 19:42:03.118842
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e00cda069185'
+down_revision = '414a282cf178'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("""
+    CREATE OR REPLACE FUNCTION notify_notifications() RETURNS trigger AS $$
+    DECLARE
+        payload text;
+    BEGIN
+        SELECT string_agg(DISTINCT s.connection_id, ',') INTO payload
+        FROM inserted i JOIN subscriptions s ON s.id = i.subscription_id;
+        IF payload IS NOT NULL THEN
+            IF length(payload) > 7900 THEN
+                payload := '';
+            END IF;
+            PERFORM pg_notify('notifications', payload);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+    CREATE TRIGGER notifications_notify AFTER INSERT ON notifications
+    REFERENCING NEW TABLE AS inserted
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_notifications();
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER notifications_notify ON notifications")
+    op.execute("DROP FUNCTION notify_notifications()")
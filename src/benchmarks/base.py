@@ -0,0 +1,57 @@
+from os import environ
+import json
+import random
+import contextlib
+from typing import Dict, List, Tuple
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy_utils import create_database, database_exists, drop_database
+
+from sql import database
+from sql.models import Connection, Subscription
+from logger.logger import logging
+
+BENCH_DB_CONN = environ.get("BENCH_DB_CONN", environ.get("TEST_DB_CONN"))
+
+# The benchmarks measure the hot path, not the log handlers.
+logging.getLogger().setLevel(logging.WARNING)
+
+
+@contextlib.contextmanager
+def bench_database(ranges: Dict[str, Tuple[float, float]], subscriptions: int):
+    """Creates a throwaway database with `subscriptions` thresholds per symbol, spread over its (low, high)."""
+    url = BENCH_DB_CONN
+    if not database_exists(url):
+        create_database(url)
+
+    engine = create_engine(url)
+    database.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        conn_id = connection.execute(insert(Connection.__table__)).inserted_primary_key[0]
+        connection.execute(insert(Subscription.__table__), [
+            {"connection_id": conn_id, "symbol": symbol, "price_threshold": random.uniform(low, high)}
+            for symbol, (low, high) in ranges.items()
+            for _ in range(subscriptions)
+        ])
+    try:
+        yield url
+    finally:
+        engine.dispose()
+        drop_database(url)
+
+
+def trade_frames(symbol: str, count: int, price: float, volatility: float = 0.001, seed: int = 0) -> List[str]:
+    """Binance-like @trade frames following a random walk."""
+    rng = random.Random(seed)
+    frames = []
+    for i in range(count):
+        price *= 1 + rng.gauss(0, volatility)
+        frames.append(json.dumps({
+            "e": "trade", "E": 1656000000000 + i, "s": symbol.upper(), "t": i, "p": f"{price:.8f}",
+            "q": "0.01000000", "b": i, "a": i, "T": 1656000000000 + i, "m": False, "M": True,
+        }, separators=(",", ":")))
+    return frames
+
+
+def report(name: str, count: int, seconds: float, unit: str = "frames"):
+    print(f"{name:<40} {count / seconds:>14,.0f} {unit}/s   ({count} in {seconds:.3f}s)")
@@ -0,0 +1,62 @@
+"""
+    Threshold evaluation of runs of trades of one symbol, price after price against vectorized with NumPy.
+
+    Run from src/, no database needed:
+        python -m benchmarks.bench_evaluation --trades 200000 --subscriptions 10000
+"""
+import argparse
+import random
+from time import perf_counter
+
+from enums import Symbol
+from thresholds import ThresholdIndex
+from benchmarks.base import report
+
+
+def scalar(index: ThresholdIndex, symbol: str, previous_price: float, prices: list) -> list:
+    crossings = []
+    for i, price in enumerate(prices):
+        if previous_price and previous_price < price:
+            sub_ids = index.crossed(symbol, previous_price, price)
+            if sub_ids:
+                crossings.append((i, sub_ids))
+        previous_price = price
+    return crossings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trades", type=int, default=200000)
+    parser.add_argument("--subscriptions", type=int, default=10000)
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 8, 32, 128, 1024])
+    args = parser.parse_args()
+
+    symbol = Symbol.BTCUSDT
+    rng = random.Random(0)
+    index = ThresholdIndex()
+    for i in range(args.subscriptions):
+        index.add(i, symbol, rng.uniform(19000, 21000))
+
+    price = 20000.0
+    prices = []
+    for _ in range(args.trades):
+        price *= 1 + rng.gauss(0, 0.001)
+        prices.append(price)
+
+    for size in args.batches:
+        batches = [prices[i:i + size] for i in range(0, len(prices), size)]
+        results = {}
+        for name, evaluate in [("scalar", scalar), ("vectorized", ThresholdIndex.crossings)]:
+            crossings = 0
+            start = perf_counter()
+            previous_price = None
+            for batch in batches:
+                crossings += sum(len(sub_ids) for _, sub_ids in evaluate(index, symbol, previous_price, batch))
+                previous_price = batch[-1]
+            report(f"{name}, batches of {size}", len(prices), perf_counter() - start, "trades")
+            results[name] = crossings
+        assert results["scalar"] == results["vectorized"], results
+
+
+if __name__ == "__main__":
+    main()
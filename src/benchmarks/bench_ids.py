@@ -0,0 +1,104 @@
+"""
+    Primary keys of 8 hex characters in VARCHAR(36), as `uuid_str` used to make them, against BIGSERIAL: inserts,
+    lookups by id, the join of the foreign key and the size of the indexes.
+
+    Run from src/, with BENCH_DB_CONN (or TEST_DB_CONN) set:
+        python -m benchmarks.bench_ids --rows 200000 --lookups 20000
+"""
+import argparse
+import random
+from time import perf_counter
+
+from sqlalchemy import create_engine, text
+from sqlalchemy_utils import create_database, database_exists, drop_database
+
+from benchmarks.base import BENCH_DB_CONN, report
+
+KEYS = {
+    "varchar": ("VARCHAR(36) PRIMARY KEY", "VARCHAR(36) NOT NULL"),
+    "bigint": ("BIGSERIAL PRIMARY KEY", "BIGINT NOT NULL"),
+}
+BATCH = 1000
+# The 8 hex characters of uuid_str, 32 bits: random ones collide well before 200000 rows.
+HEX_KEYS = 16 ** 8
+
+
+def create_tables(connection, name: str):
+    key, reference = KEYS[name]
+    connection.execute(text(f"CREATE TABLE {name}_parents (id {key}, created_at TIMESTAMP DEFAULT now())"))
+    connection.execute(text(
+        f"CREATE TABLE {name}_children (id {key}, parent_id {reference} REFERENCES {name}_parents (id), "
+        f"created_at TIMESTAMP DEFAULT now())"
+    ))
+    connection.execute(text(f"CREATE INDEX ix_{name}_children_parent ON {name}_children (parent_id)"))
+
+
+def insert_rows(connection, name: str, table: str, rows: int, parent_ids: list = None) -> list:
+    """Inserts `rows` rows, BATCH by statement, returns their ids."""
+    kind = "text" if name == "varchar" else "bigint"
+    if name == "varchar":
+        # Drawn without replacement, shaped like uuid_str
+        keys = [f"{key:08x}" for key in random.sample(range(HEX_KEYS), rows)]
+    ids = []
+    for start in range(0, rows, BATCH):
+        count = min(BATCH, rows - start)
+        columns = {}
+        if name == "varchar":
+            columns["id"] = keys[start:start + count]
+        if parent_ids:
+            columns["parent_id"] = random.choices(parent_ids, k=count)
+
+        if columns:
+            arrays = ", ".join(f"CAST(:{column} AS {kind}[])" for column in columns)
+            query = f"INSERT INTO {name}_{table} ({', '.join(columns)}) SELECT * FROM unnest({arrays}) RETURNING id"
+        else:
+            query = f"INSERT INTO {name}_{table} (created_at) SELECT now() FROM generate_series(1, {count}) " \
+                    f"RETURNING id"
+        ids.extend(connection.execute(text(query), columns).scalars().all())
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    if not database_exists(BENCH_DB_CONN):
+        create_database(BENCH_DB_CONN)
+    engine = create_engine(BENCH_DB_CONN)
+    try:
+        for name in KEYS:
+            with engine.begin() as connection:
+                create_tables(connection, name)
+
+                start = perf_counter()
+                parent_ids = insert_rows(connection, name, "parents", args.rows // 10)
+                child_ids = insert_rows(connection, name, "children", args.rows, parent_ids)
+                report(f"{name}, insert", args.rows + len(parent_ids), perf_counter() - start, "rows")
+                connection.execute(text(f"ANALYZE {name}_parents, {name}_children"))
+
+                lookups = random.choices(child_ids, k=args.lookups)
+                start = perf_counter()
+                for child_id in lookups:
+                    connection.execute(text(f"SELECT * FROM {name}_children WHERE id = :id"), {"id": child_id}).one()
+                report(f"{name}, lookup by id", args.lookups, perf_counter() - start, "rows")
+
+                start = perf_counter()
+                joined = connection.execute(text(
+                    f"SELECT count(*) FROM {name}_children c JOIN {name}_parents p ON p.id = c.parent_id"
+                )).scalar()
+                report(f"{name}, join on the foreign key", joined, perf_counter() - start, "rows")
+
+                size = connection.execute(text(
+                    f"SELECT pg_relation_size('{name}_children_pkey') + pg_relation_size('ix_{name}_children_parent')"
+                )).scalar()
+                print(f"{name + ', indexes of the children':<40} {size / 2 ** 20:>14,.1f} MiB")
+    finally:
+        engine.dispose()
+        drop_database(BENCH_DB_CONN)
+
+
+if __name__ == "__main__":
+    main()
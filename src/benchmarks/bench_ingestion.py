@@ -0,0 +1,75 @@
+"""
+    Frames per second through Ingestion.on_message, compared to the former session-per-frame ORM path.
+
+    Run from src/ with a reachable Postgres (BENCH_DB_CONN, defaults to TEST_DB_CONN):
+        python -m benchmarks.bench_ingestion --frames 20000 --subscriptions 10000
+"""
+import argparse
+import json
+from time import perf_counter
+
+from sql.data import list_current_subscriptions_from_symbol
+from sql.models import Notification
+from ingestion import Ingestion
+from enums import Symbol
+from benchmarks.base import bench_database, trade_frames, report
+
+
+def legacy_on_message(ingestion: Ingestion, message: str):
+    # on_message before the mirror and the writer: one session per frame, ORM query and commit per uptick.
+    session = ingestion.sessionlocal()
+    message = json.loads(message)
+    if "e" not in message or message["e"] != "trade":
+        session.close()
+        return
+
+    symbol = message["s"].lower()
+    current_price = float(message["p"])
+    previous_price = ingestion.previous_prices.get(symbol, None)
+    if previous_price and previous_price < current_price:
+        subs = list_current_subscriptions_from_symbol(session, symbol)
+        notifications = [
+            Notification(
+                subscription_id=sub.id,
+                symbol=sub.symbol,
+                message=f"Price has surpassed the threshold: {current_price}",
+                order_ref=int(message["E"])/1000
+            )
+            for sub in subs
+            if previous_price < sub.price_threshold and sub.price_threshold < current_price
+        ]
+        session.add_all(notifications)
+        session.commit()
+
+    ingestion.previous_prices[symbol] = current_price
+    session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--subscriptions", type=int, default=10000)
+    args = parser.parse_args()
+
+    price = 20000.0
+    frames = trade_frames(Symbol.BTCUSDT, args.frames, price)
+    with bench_database({Symbol.BTCUSDT: (price * 0.9, price * 1.1)}, args.subscriptions) as url:
+        ingestion = Ingestion(db_credentials=url)
+        ingestion.subscriptions.refresh()
+
+        start = perf_counter()
+        for frame in frames:
+            legacy_on_message(ingestion, frame)
+        report("legacy on_message", len(frames), perf_counter() - start)
+
+        ingestion.previous_prices = {}
+        start = perf_counter()
+        for frame in frames:
+            ingestion.on_message(None, frame)
+        report("on_message", len(frames), perf_counter() - start)
+        ingestion.notifications.flush()
+        report("on_message + notifications written", len(frames), perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+    Parse cost per trade frame, standard library json against the serialization module (orjson when installed).
+
+    Run from src/, no database needed:
+        python -m benchmarks.bench_serialization --frames 200000
+"""
+import argparse
+import json
+from time import perf_counter
+
+import serialization
+from enums import Symbol
+from benchmarks.base import trade_frames
+
+
+def per_frame(name: str, count: int, seconds: float):
+    print(f"{name:<40} {seconds / count * 1e6:>8.3f} us/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=200000)
+    args = parser.parse_args()
+
+    frames = trade_frames(Symbol.BTCUSDT, args.frames, 20000.0)
+    print(f"serialization backend: {'orjson' if serialization.orjson else 'json'}")
+
+    for name, loads, dumps in [("json", json.loads, json.dumps),
+                               ("serialization", serialization.loads, serialization.dumps)]:
+        start = perf_counter()
+        messages = [loads(frame) for frame in frames]
+        per_frame(f"{name}.loads", len(frames), perf_counter() - start)
+
+        start = perf_counter()
+        for message in messages:
+            dumps(message)
+        per_frame(f"{name}.dumps", len(frames), perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
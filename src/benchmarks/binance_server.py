@@ -0,0 +1,184 @@
+"""
+    Local stand-in for the Binance `/ws` endpoint, to run the ingestion end to end without the exchange.
+
+    It answers SUBSCRIBE, UNSUBSCRIBE and LIST_SUBSCRIPTIONS requests like Binance does, then streams synthetic
+    `<symbol>@trade` frames for every subscribed symbol, at `rate` frames per second and following a price process:
+    - walk: geometric random walk, `volatility` being the standard deviation of each step
+    - sine: oscillates by `volatility` * 100 around the start price, one period every 1000 frames
+    - ramp: rises by `volatility` of the start price on every frame, crossing every threshold above it
+
+    Run from src/, then point the ingestion to it with BINANCE_WS_URI=ws://localhost:9443/ws:
+        python -m benchmarks.binance_server --port 9443 --rate 100 --process walk
+"""
+import argparse
+import asyncio
+import math
+import random
+from time import time
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+import websockets
+
+from logger.logger import logging
+import serialization
+
+
+def random_walk(price: float, volatility: float, rng: random.Random) -> Iterator[float]:
+    while True:
+        price *= 1 + rng.gauss(0, volatility)
+        yield price
+
+
+def sine(price: float, volatility: float, rng: random.Random) -> Iterator[float]:
+    step = 0
+    while True:
+        step += 1
+        yield price * (1 + volatility * 100 * math.sin(2 * math.pi * step / 1000))
+
+
+def ramp(price: float, volatility: float, rng: random.Random) -> Iterator[float]:
+    increment = price * volatility
+    while True:
+        price += increment
+        yield price
+
+
+PRICE_PROCESSES: Dict[str, Callable[[float, float, random.Random], Iterator[float]]] = {
+    "walk": random_walk,
+    "sine": sine,
+    "ramp": ramp,
+}
+
+
+class BinanceServer:
+    """
+        Speaks the Binance websocket protocol for trade streams, on `url` once started.
+
+        Each client gets its own subscriptions and one streaming task per subscribed symbol. The requests received
+        are kept in `requests`, and `disconnect` drops every client, to exercise what happens on the other side.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 0, rate: float = 10.0, process: str = "walk",
+                 price: float = 20000.0, volatility: float = 0.001, prices: Optional[Dict[str, float]] = None,
+                 seed: Optional[int] = None) -> None:
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.process = PRICE_PROCESSES[process]
+        self.price = price
+        self.volatility = volatility
+        # Start price per symbol, `price` for the others
+        self.prices = prices or {}
+        self.rng = random.Random(seed)
+        self.server = None
+        # The loop serving the clients, for the callers running on other threads
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.clients: Dict[websockets.WebSocketServerProtocol, Dict[str, asyncio.Task]] = {}
+        self.requests: List[dict] = []
+        self.trade_id = 0
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}/ws"
+
+    def subscriptions(self) -> Set[str]:
+        """Symbols streamed to at least one client."""
+        return {symbol for streams in self.clients.values() for symbol in streams}
+
+    async def start(self) -> "BinanceServer":
+        self.loop = asyncio.get_running_loop()
+        self.server = await websockets.serve(self.handle, self.host, self.port)
+        # Picked by the system when 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"Binance stand-in listening on {self.url}")
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def disconnect(self):
+        for websocket in list(self.clients):
+            await websocket.close()
+
+    async def handle(self, websocket: websockets.WebSocketServerProtocol, path: str = None):
+        streams = self.clients[websocket] = {}
+        try:
+            async for message in websocket:
+                await websocket.send(serialization.dumps(self.answer(websocket, streams, message)))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in streams.values():
+                task.cancel()
+            del self.clients[websocket]
+
+    def answer(self, websocket, streams: Dict[str, asyncio.Task], message: str) -> dict:
+        try:
+            request = serialization.loads(message)
+            method, params, request_id = request["method"], request.get("params", []), request["id"]
+        except (ValueError, KeyError, TypeError):
+            return {"error": {"code": 2, "msg": "Invalid request"}, "id": None}
+        self.requests.append(request)
+
+        if method == "LIST_SUBSCRIPTIONS":
+            return {"result": [f"{symbol}@trade" for symbol in streams], "id": request_id}
+        if method not in ("SUBSCRIBE", "UNSUBSCRIBE") or \
+                not all(isinstance(param, str) and param.endswith("@trade") for param in params):
+            return {"error": {"code": 2, "msg": f"Invalid request: {message}"}, "id": request_id}
+
+        for symbol in (param[:-len("@trade")] for param in params):
+            if method == "SUBSCRIBE" and symbol not in streams:
+                streams[symbol] = asyncio.create_task(self.stream(websocket, symbol))
+            elif method == "UNSUBSCRIBE" and symbol in streams:
+                streams.pop(symbol).cancel()
+        return {"result": None, "id": request_id}
+
+    async def stream(self, websocket: websockets.WebSocketServerProtocol, symbol: str):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.rate
+        deadline = loop.time()
+        prices = self.process(self.prices.get(symbol, self.price), self.volatility, self.rng)
+        try:
+            for price in prices:
+                await websocket.send(self.trade_frame(symbol, price))
+                # Keeps the rate on average, whatever the time spent sending
+                deadline += interval
+                await asyncio.sleep(max(0.0, deadline - loop.time()))
+        except websockets.ConnectionClosed:
+            pass
+
+    def trade_frame(self, symbol: str, price: float) -> str:
+        self.trade_id += 1
+        now = int(time() * 1000)
+        return serialization.dumps({
+            "e": "trade", "E": now, "s": symbol.upper(), "t": self.trade_id, "p": f"{price:.8f}",
+            "q": "0.01000000", "b": self.trade_id, "a": self.trade_id, "T": now, "m": False, "M": True,
+        })
+
+
+async def serve(server: BinanceServer):
+    await server.start()
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9443)
+    parser.add_argument("--rate", type=float, default=10.0, help="trade frames per second and symbol")
+    parser.add_argument("--process", choices=sorted(PRICE_PROCESSES), default="walk")
+    parser.add_argument("--price", type=float, default=20000.0, help="start price of every symbol")
+    parser.add_argument("--volatility", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = BinanceServer(args.host, args.port, args.rate, args.process, args.price, args.volatility, seed=args.seed)
+    try:
+        asyncio.run(serve(server))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+    Replays a recorded trade stream through the ingestion, as fast as possible or at a multiple of its pace.
+
+    The recording is a JSONL file with one `<symbol>@trade` event per line, exactly as the `/ws` endpoint of
+    Binance sends it: {"e":"trade","E":<event time, ms>,"s":"BTCUSDT","p":"<price>",...}. "E" paces the replay.
+    It may be compressed with gzip, bz2 or xz (.gz, .bz2, .xz suffix). Thresholds are generated over the price
+    range of every recorded symbol, in a throwaway database (BENCH_DB_CONN, defaults to TEST_DB_CONN).
+
+    --capture records one from BINANCE_WS_URI (or the local Binance stand-in), --synthesize writes a random walk.
+
+    Run from src/ with a reachable Postgres:
+        python -m benchmarks.replay trades.jsonl.gz --capture btcusdt ethusdt --seconds 600
+        python -m benchmarks.replay trades.jsonl.gz --synthesize 200000
+        python -m benchmarks.replay trades.jsonl.gz --subscriptions 1000
+        python -m benchmarks.replay trades.jsonl.gz --speed 10
+"""
+import argparse
+import asyncio
+import bz2
+import gzip
+import lzma
+from os import environ
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+from sqlalchemy.engine import Engine
+
+import serialization
+from enums import Symbol
+from ingestion import Ingestion
+from writer import NotificationWriter
+from benchmarks.base import bench_database, trade_frames, report
+
+OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def open_recording(path: str, mode: str = "rt"):
+    return OPENERS.get(Path(path).suffix, open)(path, mode)
+
+
+async def capture(url: str, symbols: List[str], path: str, seconds: float) -> int:
+    """Records the trades of `symbols` streamed by `url` during `seconds`, returns how many were written."""
+    loop = asyncio.get_running_loop()
+    count = 0
+    async with websockets.connect(url) as websocket:
+        await websocket.send(serialization.dumps({
+            "method": "SUBSCRIBE", "params": [f"{symbol.lower()}@trade" for symbol in symbols], "id": 1,
+        }))
+        deadline = loop.time() + seconds
+        with open_recording(path, "wt") as recording:
+            try:
+                while True:
+                    message = await asyncio.wait_for(websocket.recv(), deadline - loop.time())
+                    # Leaves out the answer to the SUBSCRIBE request
+                    if serialization.loads(message).get("e") == "trade":
+                        recording.write(message + "\n")
+                        count += 1
+            except asyncio.TimeoutError:
+                pass
+    return count
+
+
+def read_recording(path: str) -> Tuple[List[Tuple[float, str]], Dict[str, Tuple[float, float]]]:
+    """(event time in seconds, frame) for every line, and the (low, high) price of every traded symbol."""
+    frames = []
+    ranges = {}
+    event_time = 0.0
+    with open_recording(path) as recording:
+        for line in recording:
+            line = line.strip()
+            if not line:
+                continue
+            message = serialization.loads(line)
+            event_time = message.get("E", event_time * 1000) / 1000
+            frames.append((event_time, line))
+
+            if message.get("e") == "trade":
+                symbol, price = message["s"].lower(), float(message["p"])
+                low, high = ranges.get(symbol, (price, price))
+                ranges[symbol] = (min(low, price), max(high, price))
+    return frames, ranges
+
+
+class TimedWriter(NotificationWriter):
+    """Notification writer keeping how long every notification waited between its evaluation and its commit."""
+
+    def __init__(self, engine: Engine) -> None:
+        super().__init__(engine)
+        self.stamps: List[float] = []
+        self.taken: Dict[int, List[float]] = {}
+        self.latencies: List[float] = []
+
+    def put(self, notifications: List[Dict]):
+        self.stamps.extend([perf_counter()] * len(notifications))
+        super().put(notifications)
+
+    def take(self) -> List[Dict]:
+        batch = super().take()
+        self.taken[id(batch)] = self.stamps[:len(batch)]
+        del self.stamps[:len(batch)]
+        return batch
+
+    def write(self, batch: List[Dict]) -> bool:
+        if not super().write(batch):
+            return False
+        stamps = self.taken.pop(id(batch))
+        committed = perf_counter()
+        self.latencies.extend(committed - stamp for stamp in stamps)
+        return True
+
+    async def retry(self, batch: List[Dict]):
+        stamps = self.taken.pop(id(batch))
+        await super().retry(batch)
+        # Back in front of the buffer unless dropped
+        if self.buffer and self.buffer[0] is batch[0]:
+            self.stamps[:0] = stamps
+
+
+async def replay(ingestion: Ingestion, frames: List[Tuple[float, str]], speed: Optional[float], burst: int) -> float:
+    """Feeds the frames to on_message like the upstream connections do, returns the seconds it took to receive them."""
+    ingestion.loop = asyncio.get_running_loop()
+    writer = asyncio.create_task(ingestion.notifications.run(ingestion.executor))
+    ingestion.evaluator = asyncio.create_task(ingestion.evaluate_ticks())
+
+    start = perf_counter()
+    first = frames[0][0]
+    try:
+        for i, (event_time, frame) in enumerate(frames):
+            if speed:
+                delay = start + (event_time - first) / speed - perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            ingestion.on_message(None, frame)
+            # A burst of frames read from the socket at once, then the other tasks get their turn
+            if (i + 1) % burst == 0:
+                await asyncio.sleep(0)
+        return perf_counter() - start
+    finally:
+        writer.cancel()
+        ingestion.evaluator.cancel()
+        ingestion.evaluator = None
+
+
+def percentiles(name: str, seconds: List[float]):
+    if not seconds:
+        print(f"{name:<40} no samples")
+        return
+    seconds = sorted(seconds)
+    at = {p: seconds[min(len(seconds) - 1, int(len(seconds) * p / 100))] * 1e3 for p in (50, 95, 99)}
+    print(f"{name:<40} p50 {at[50]:.2f} ms   p95 {at[95]:.2f} ms   p99 {at[99]:.2f} ms   "
+          f"max {seconds[-1] * 1e3:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="JSONL file of frames, optionally .gz, .bz2 or .xz")
+    parser.add_argument("--subscriptions", type=int, default=1000, help="thresholds per recorded symbol")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="multiple of the recorded pace, as fast as possible when not set")
+    parser.add_argument("--burst", type=int, default=1, help="frames handled per event loop iteration")
+    parser.add_argument("--synthesize", type=int, default=None, metavar="FRAMES",
+                        help="first writes a BTCUSDT random walk of FRAMES trades, 1ms apart, to the recording")
+    parser.add_argument("--capture", nargs="+", default=None, metavar="SYMBOL",
+                        help="first records the trades of the symbols from --url to the recording")
+    parser.add_argument("--url", default=environ.get("BINANCE_WS_URI", "wss://stream.binance.com:9443/ws"))
+    parser.add_argument("--seconds", type=float, default=60, help="duration of the --capture")
+    args = parser.parse_args()
+
+    if args.capture:
+        count = asyncio.run(capture(args.url, args.capture, args.recording, args.seconds))
+        print(f"{count} trades captured from {args.url}")
+    elif args.synthesize:
+        with open_recording(args.recording, "wt") as recording:
+            for frame in trade_frames(Symbol.BTCUSDT, args.synthesize, 20000.0):
+                recording.write(frame + "\n")
+
+    frames, ranges = read_recording(args.recording)
+    print(f"{len(frames)} frames of {len(ranges)} symbols from {args.recording}")
+
+    with bench_database(ranges, args.subscriptions) as url:
+        ingestion = Ingestion(db_credentials=url, sharding=False)
+        ingestion.notifications = writer = TimedWriter(ingestion.engine)
+        ingestion.subscriptions.refresh()
+
+        start = perf_counter()
+        received = asyncio.run(replay(ingestion, frames, args.speed, args.burst))
+        # Whatever the tasks left behind, then the batch the writer may still have in flight
+        ingestion.flush()
+        ingestion.executor.shutdown(wait=True)
+        elapsed = perf_counter() - start
+
+        report("frames received", len(frames), received)
+        report("frames evaluated and written", len(frames), elapsed)
+        report("crossings written", len(writer.latencies), elapsed, "crossings")
+        percentiles("evaluation -> commit latency", writer.latencies)
+        ingestion.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import asyncio
+from concurrent.futures import Executor
+from time import monotonic
+from typing import Dict, List, Optional
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+from sql.data import (
+    claim_pending_notifications, release_notifications, finish_notifications, heartbeat_subscriptions,
+    NOTIFICATION_CLAIM_BATCH,
+)
+from sql.models import Notification
+from metrics import DELIVERY_QUEUE_DEPTH
+from logger.logger import logging
+
+
+def primary_key(notification: Notification) -> Dict:
+    return {"id": notification.id, "created_at": notification.created_at}
+
+
+class NotificationHub:
+    """
+        Fan-out of the notifications to the websockets of a webserver worker.
+
+        A single dispatcher task claims the pending notifications of every subscription of the worker with one
+        UPDATE ... RETURNING, which leases them, and routes them by subscription_id to the queue of their
+        connection. Claims skip the rows locked or leased by other claims, several workers or replicas don't send
+        the same notification. The websockets only drain their queue and `ack` what they sent, or `release` what
+        they could not send. Before its next claim, the dispatcher finishes the acked notifications with one UPDATE
+        and makes the released ones pending again with one statement.
+
+        The dispatcher claims when woken up by the NOTIFY of new notifications and every `poll_interval` seconds
+        anyway. On `close`, the acks are written and the notifications claimed and not sent yet are made pending
+        again, for the other workers. The claims of a worker that dies are pending again once their lease expires,
+        so a notification it sent without writing the ack is delivered twice, never lost.
+
+        The hub also keeps the subscriptions of its connections alive: every `heartbeat_interval` seconds all of
+        them are heartbeated with a single UPDATE.
+
+        Its queries run on `executor` (the default one of the loop if None), the routing stays on the loop.
+    """
+
+    def __init__(self, engine: Engine, poll_interval: float, heartbeat_interval: float,
+                 executor: Optional[Executor] = None) -> None:
+        self.sessionlocal: sessionmaker = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                                       bind=engine)
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_at = monotonic()
+        self.executor = executor
+        # Queues of the connections, by connection id, and the same queues by subscription id
+        self.queues: Dict[int, asyncio.Queue] = {}
+        self.routes: Dict[int, asyncio.Queue] = {}
+        # Primary keys of the claimed notifications not sent yet, by id
+        self.inflight: Dict[int, Dict] = {}
+        # Primary keys of the claimed notifications given back, by id
+        self.released: Dict[int, Dict] = {}
+        # Primary keys of the notifications sent and not finished yet, by id
+        self.acked: Dict[int, Dict] = {}
+        self.stale = True
+        self.closing = False
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        DELIVERY_QUEUE_DEPTH.set_function(lambda: len(self.inflight))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is None:
+            return
+        # Lets a claim in progress route what it claimed, cancelling it would lose them
+        self.closing = True
+        self.wakeup.set()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+        # Queued notifications are in flight too, the websockets must not send them anymore
+        for queue in self.queues.values():
+            while not queue.empty():
+                queue.get_nowait()
+        released, acked = {**self.inflight, **self.released}, self.acked
+        self.inflight, self.released, self.acked = {}, {}, {}
+        if not released and not acked:
+            return
+        try:
+            await self.run_blocking(self.write_and_claim, list(released.values()), list(acked.values()), [])
+        except Exception as e:
+            logging.error(f"Could not release {len(released)} and finish {len(acked)} notifications: {e}")
+
+    def register(self, conn_id: int) -> asyncio.Queue:
+        queue = self.queues[conn_id] = asyncio.Queue()
+        return queue
+
+    def subscribe(self, conn_id: int, sub_id: int):
+        self.routes[sub_id] = self.queues[conn_id]
+
+    def unregister(self, conn_id: int):
+        queue = self.queues.pop(conn_id, None)
+        if queue is None:
+            return
+        for sub_id in [sub_id for sub_id, routed in self.routes.items() if routed is queue]:
+            del self.routes[sub_id]
+        while not queue.empty():
+            self.release(queue.get_nowait())
+
+    def release(self, notification: Notification):
+        """Gives up a claimed notification: it is pending again after the next dispatch."""
+        self.inflight.pop(notification.id, None)
+        self.released[notification.id] = primary_key(notification)
+        self.wakeup.set()
+
+    def ack(self, notification: Notification):
+        """Reports a sent notification: it is finished by the next dispatch."""
+        self.inflight.pop(notification.id, None)
+        self.acked[notification.id] = primary_key(notification)
+        self.wakeup.set()
+
+    def wake(self, payload: str):
+        """Handles the NOTIFY of new notifications: comma separated connection ids, or empty for all of them."""
+        if payload and not any(int(conn_id) in self.queues for conn_id in payload.split(",")):
+            return
+        self.stale = True
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                self.stale = True
+            self.wakeup.clear()
+            if self.closing:
+                return
+            try:
+                await self.dispatch()
+            except Exception as e:
+                logging.error(f"Could not dispatch the notifications: {e}")
+            if monotonic() - self.heartbeat_at >= self.heartbeat_interval:
+                try:
+                    await self.heartbeat()
+                except Exception as e:
+                    logging.error(f"Could not heartbeat the subscriptions: {e}")
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def dispatch(self):
+        released, self.released = self.released, {}
+        acked, self.acked = self.acked, {}
+        claim, self.stale = self.stale and self.routes, False
+        if not released and not acked and not claim:
+            return
+
+        try:
+            notifications = await self.run_blocking(self.write_and_claim, list(released.values()),
+                                                    list(acked.values()), list(self.routes) if claim else [])
+        except Exception:
+            # Written and claimed again by the next dispatch
+            self.released.update(released)
+            self.acked.update(acked)
+            self.stale = self.stale or bool(claim)
+            raise
+        # A full batch, more are pending
+        if len(notifications) >= NOTIFICATION_CLAIM_BATCH:
+            self.stale = True
+            self.wakeup.set()
+        self.route(notifications)
+
+    def write_and_claim(self, released: List[Dict], acked: List[Dict], sub_ids: List[int]) -> List[Notification]:
+        """
+            Makes the `released` notifications pending again and finishes the `acked` ones, then claims the ones of
+            `sub_ids`. Runs off the loop.
+        """
+        session = self.sessionlocal()
+        try:
+            if released:
+                release_notifications(session, released)
+            if acked:
+                finish_notifications(session, acked)
+            if released or acked:
+                session.commit()
+            if not sub_ids:
+                return []
+            notifications = claim_pending_notifications(session, sub_ids, NOTIFICATION_CLAIM_BATCH)
+            session.commit()
+            return notifications
+        finally:
+            session.close()
+
+    async def heartbeat(self):
+        self.heartbeat_at = monotonic()
+        if not self.routes:
+            return
+
+        heartbeated = await self.run_blocking(self.write_heartbeats, list(self.routes))
+        logging.debug(f"{heartbeated} subscriptions heartbeated")
+
+    def write_heartbeats(self, sub_ids: List[int]) -> int:
+        session = self.sessionlocal()
+        try:
+            heartbeated = heartbeat_subscriptions(session, sub_ids)
+            session.commit()
+        finally:
+            session.close()
+        return heartbeated
+
+    def route(self, notifications):
+        for notification in notifications:
+            self.inflight[notification.id] = primary_key(notification)
+            queue = self.routes.get(notification.subscription_id)
+            # Unregistered while claiming
+            if queue is None:
+                self.release(notification)
+                continue
+            queue.put_nowait(notification)
@@ -1,148 +1,262 @@
 from os import environ
-import json
+import asyncio
+from typing import List
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
-from threading import Timer
+from time import time
 
 from sqlalchemy import create_engine, inspect
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker
 
-from sql.data import (list_current_sub_symbols, list_current_subscriptions_from_symbol)
-from sql.models import Notification
 from sql import database
-from websocket import WebSocketApp
-from logger.logger import logging
+from sql.database import InstrumentedQueuePool
+from sql.notify import Listener, SUBSCRIPTIONS_CHANNEL
+from mirror import SubscriptionMirror
+from writer import NotificationWriter
+from streams import StreamPool, StreamConnection
+from sharding import ShardCoordinator, INGESTION_SHARDING
+from thresholds import np
+from ticks import Tick, TickQueue
+from metrics import (TICK_QUEUE_DEPTH, ALERT_LATENCY, FRAMES_RECEIVED, TRADES_EVALUATED, CROSSINGS,
+                     ACTIVE_SUBSCRIPTIONS, start_metrics_server, measure_loop_lag)
+from logger.logger import logging, debug_enabled
+import serialization
 
 root_path = Path(__file__).parent.parent
 
+# Subscriptions are reconciled as soon as the webserver creates or finishes one (NOTIFY), and every this many
+# seconds anyway. It also paces the worker heartbeats when sharding, keep it below WORKER_LEASE / 3.
+SUBSCRIPTION_RECONCILE_INTERVAL = float(environ.get("SUBSCRIPTION_RECONCILE_INTERVAL", 2))
+
+# Runs of trades of a symbol at least this long are evaluated with NumPy, 0 turns it off. A symbol's pending trades
+# are handed to the evaluation once past it, instead of being coalesced past TICK_QUEUE_SYMBOL_SIZE.
+VECTORIZE_MIN_TICKS = int(environ.get("VECTORIZE_MIN_TICKS", 128)) if np is not None else 0
+
 
 class Ingestion:
 
-    def __init__(self, api_url: str = None, db_credentials: str = None) -> None:
+    def __init__(self, api_url: str = None, db_credentials: str = None, sharding: bool = INGESTION_SHARDING) -> None:
         self.api_url = api_url or environ.get("BINANCE_WS_URI")
         self.db_credentials = db_credentials or environ.get("PSQL_CONN")
-        self.engine = create_engine(self.db_credentials,
+        self.engine = create_engine(self.db_credentials, poolclass=InstrumentedQueuePool,
                                     pool_size=20, max_overflow=0)
         self.sessionlocal: sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-        # This holds the symbols we have already subscribed into the exchange.
-        self.symbol_subs = {'etcusdt'}
-        self.last_id = 1
+        # Upstream connections to the exchange and the symbols streamed through each one.
+        self.streams = StreamPool(self.api_url, on_message=self.on_message, on_error=self.on_error)
         self.previous_prices = {}
+        # Trades received and not evaluated yet, bounded per symbol under backpressure. With NumPy, the run of a symbol
+        # past VECTORIZE_MIN_TICKS is evaluated at once, vectorized. Without it, the run is coalesced.
+        self.ticks = TickQueue(VECTORIZE_MIN_TICKS, evaluate=self.evaluate) if VECTORIZE_MIN_TICKS else TickQueue()
+        TICK_QUEUE_DEPTH.set_function(lambda: len(self.ticks))
+        # Live subscriptions, refreshed by check_current_subs, so ticks never hit the database.
+        self.subscriptions = SubscriptionMirror(self.sessionlocal)
+        ACTIVE_SUBSCRIPTIONS.set_function(lambda: len(self.subscriptions))
+        # Children of FRAMES_RECEIVED per symbol, looked up once
+        self.frames_received = {}
+        self.notifications = NotificationWriter(self.engine)
+        # Splits the symbols with the other ingestion processes, when running more than one.
+        self.shards = ShardCoordinator(self.engine) if sharding else None
+        # Blocking database calls run here, off the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingestion-db")
+        self.loop = None
+        # The task of serve, it only ends when cancelled
+        self.serving = None
+        self.evaluator = None
+        self.reconciler = None
+        # Set by the NOTIFY of subscription changes, on the loop
+        self.subscriptions_changed = None
+        self.listener = Listener(self.engine, {SUBSCRIPTIONS_CHANNEL: self.on_subscriptions_changed})
         self.setup_database()
 
+    @property
+    def symbol_subs(self):
+        # This holds the symbols we have already subscribed into the exchange.
+        return self.streams.symbols()
+
     def setup_database(self):
         if not inspect(self.engine).get_table_names(schema='public'):
             database.Base.metadata.bind = self.engine
             database.Base.metadata.create_all()
 
-    def on_error(self, ws: WebSocketApp, error: Exception):
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def on_error(self, ws: StreamConnection, error: Exception):
         logging.error(error)
 
-    def on_open(self, ws: WebSocketApp):
-        self.check_current_subs_periodically(ws, 0.55)
+    async def on_open(self, ws: StreamConnection):
+        # Rounds must not overlap: once the reconciler runs, a reconnect only asks it for another round
+        if self.reconciler is None:
+            await self.check_current_subs()
+            self.reconciler = asyncio.create_task(self.check_current_subs_periodically(SUBSCRIPTION_RECONCILE_INTERVAL))
+        else:
+            self.on_subscriptions_changed("")
+
+    def on_subscriptions_changed(self, payload: str):
+        if self.subscriptions_changed is not None:
+            self.subscriptions_changed.set()
 
-    def on_message(self, ws: WebSocketApp, message: str):
-        session: Session = self.sessionlocal()
-        message = json.loads(message)
-        logging.debug(f"[Message]: {json.dumps(message)}")
+    def on_message(self, ws: StreamConnection, message: str):
+        received_at = time()
+        if debug_enabled():
+            logging.debug(f"[Message]: {message}")
+        message = serialization.loads(message)
 
         if "e" not in message or message["e"] != "trade":
-            session.close()
             return
 
         symbol = message["s"].lower()
-        current_price = float(message["p"])
+        frames_received = self.frames_received.get(symbol)
+        if frames_received is None:
+            frames_received = self.frames_received[symbol] = FRAMES_RECEIVED.labels(symbol)
+        frames_received.inc()
+        # Frames still in flight for a symbol handed over to another worker
+        if self.shards is not None and symbol not in self.streams.owners:
+            return
+
+        tick = Tick(float(message["p"]), int(message["E"]), received_at)
+        if self.evaluator is None:
+            self.evaluate(symbol, [tick])
+        else:
+            # Evaluated by the evaluation task, receiving keeps going meanwhile
+            self.ticks.put(symbol, tick)
+
+    def evaluate(self, symbol: str, ticks: List[Tick]):
+        TRADES_EVALUATED.inc(len(ticks))
         previous_price = self.previous_prices.get(symbol, None)
+        if VECTORIZE_MIN_TICKS and len(ticks) >= VECTORIZE_MIN_TICKS:
+            # Every rise of the run at once, in the order of the loop below
+            for index, sub_ids in self.subscriptions.crossings(symbol, previous_price, [t.price for t in ticks]):
+                self.notify(symbol, ticks[index], sub_ids)
+        else:
+            for tick in ticks:
+                current_price = tick.price
+                # Proceed if price rose
+                if previous_price and previous_price < current_price:
+                    # Publish Notification for every threshold the current price surpassed
+                    sub_ids = self.subscriptions.crossed(symbol, previous_price, current_price)
+                    if sub_ids:
+                        self.notify(symbol, tick, sub_ids)
+                previous_price = current_price
 
-        # Proceed if price rose
-        if previous_price and previous_price < current_price:
-            subs = list_current_subscriptions_from_symbol(session, symbol)
-            # Publish Notification if current price surpassed the threshold
-            notifications = [
-                Notification(
-                    subscription_id=sub.id,
-                    symbol=sub.symbol,
-                    message=f"Price has surpassed the threshold: {current_price}",
-                    order_ref=int(message["E"])/1000
-                )
-                for sub in subs
-                if previous_price < sub.price_threshold and sub.price_threshold < current_price
-            ]
-            session.add_all(notifications)
-            session.commit()
-            logging.info(f"publish notifications: {json.dumps([n.to_json() for n in notifications])}")
-
-        self.previous_prices[symbol] = current_price
-        session.close()
-
-    def subscribe_to_ingestion(self, ws: WebSocketApp, id: int, symbol: str):
-        message = {
-            "method": "SUBSCRIBE",
-            "params": [
-                f"{symbol}@trade"
-            ],
-            "id": id,
-        }
-        logging.info(f"[Message]: {json.dumps(message)}")
-        ws.send(json.dumps(message))
-        self.symbol_subs.add(symbol)
-        self.last_id = id
-
-    def unsubscribe_to_ingestion(self, ws: WebSocketApp, id: int, symbol: str):
-        message = {
-            "method": "UNSUBSCRIBE",
-            "params": [
-                f"{symbol}@trade"
-            ],
-            "id": id,
+        self.previous_prices[symbol] = ticks[-1].price
+
+    def notify(self, symbol: str, tick: Tick, sub_ids: List[int]):
+        detected_at = time()
+        CROSSINGS.inc(len(sub_ids))
+        ALERT_LATENCY.labels("receipt").observe(tick.received_at - tick.event_time/1000)
+        ALERT_LATENCY.labels("detection").observe(detected_at - tick.received_at)
+
+        text = f"Price has surpassed the threshold: {tick.price}"
+        order_ref = tick.event_time/1000
+        timestamps = {
+            "event_at": datetime.utcfromtimestamp(order_ref),
+            "received_at": datetime.utcfromtimestamp(tick.received_at),
+            "detected_at": datetime.utcfromtimestamp(detected_at),
         }
-        logging.info(f"[Send]: {json.dumps(message)}")
-        ws.send(json.dumps(message))
-        self.symbol_subs.remove(symbol)
-        self.last_id = id
-
-    def check_current_subs_periodically(self, ws: WebSocketApp, period: float):
-
-        self.check_current_subs(ws)
-        thread = Timer(
-            period,
-            lambda: self.check_current_subs_periodically(ws, period)
-        )
-        thread.daemon = True
-        thread.start()
-
-    def check_current_subs(self, ws: WebSocketApp):
-        session = self.sessionlocal()
+        # Plain rows, written in batches by the notification writer task
+        self.notifications.put([
+            {"subscription_id": sub_id, "symbol": symbol, "message": text, "order_ref": order_ref, **timestamps}
+            for sub_id in sub_ids
+        ])
+
+    async def evaluate_ticks(self):
+        self.ticks.ready = asyncio.Event()
         try:
-            logging.debug("Checking subscriptions")
+            while True:
+                await self.ticks.ready.wait()
+                for symbol, ticks in self.ticks.drain():
+                    self.evaluate(symbol, ticks)
+                # Let the connections receive before the next round
+                await asyncio.sleep(0)
+        finally:
+            self.ticks.ready = None
 
-            open_symbols = set(list_current_sub_symbols(session))
-            to_subscribe = open_symbols - self.symbol_subs
-            to_unsubscribe = self.symbol_subs - open_symbols
+    def flush(self):
+        """Evaluates the queued trades and writes the pending notifications right away."""
+        for symbol, ticks in self.ticks.drain():
+            self.evaluate(symbol, ticks)
+        self.notifications.flush()
 
-            for symbol in to_subscribe:
-                self.subscribe_to_ingestion(ws, self.last_id+1, symbol)
+    async def check_current_subs_periodically(self, period: float):
+        """Reconciles on every change of the subscriptions, or after `period` seconds without any."""
+        self.subscriptions_changed = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.subscriptions_changed.wait(), period)
+                except asyncio.TimeoutError:
+                    pass
+                # Changes notified meanwhile are picked up by this round or trigger the next one
+                self.subscriptions_changed.clear()
+                await self.check_current_subs()
+        finally:
+            self.subscriptions_changed = None
+
+    async def check_current_subs(self):
+        try:
+            logging.debug("Checking subscriptions")
 
-            for symbol in to_unsubscribe:
-                self.unsubscribe_to_ingestion(ws, self.last_id+1, symbol)
+            self.subscriptions.update(await self.run_blocking(self.subscriptions.fetch))
+            symbols = self.subscriptions.symbols()
+            if self.shards is not None:
+                symbols = await self.run_blocking(self.shards.claim, symbols)
 
-            self.symbol_subs.update(to_subscribe)
-            self.symbol_subs = self.symbol_subs - to_unsubscribe
+            dropped = self.streams.symbols() - symbols
+            await self.streams.update(symbols)
+            # A stale price would fake a crossing once the symbol is streamed again
+            for symbol in dropped:
+                self.previous_prices.pop(symbol, None)
+
+            if self.shards is not None:
+                await self.run_blocking(self.shards.release)
         except Exception as e:
             logging.error(e)
+
+    async def serve(self) -> StreamConnection:
+        self.loop = asyncio.get_running_loop()
+        self.serving = asyncio.current_task()
+        # Reconciles the subscriptions once open, the other connections are opened on demand
+        connection = self.streams.open(on_open=self.on_open, pinned=True)
+        writer = asyncio.create_task(self.notifications.run(self.executor))
+        self.evaluator = asyncio.create_task(self.evaluate_ticks())
+        loop_lag = asyncio.create_task(measure_loop_lag())
+        self.listener.start()
+        if threading.current_thread() is threading.main_thread():
+            self.loop.add_signal_handler(signal.SIGTERM, self.serving.cancel)
+
+        try:
+            return await connection.run()
         finally:
-            session.close()
+            writer.cancel()
+            loop_lag.cancel()
+            await self.listener.close()
+            self.evaluator.cancel()
+            self.evaluator = None
+            if self.reconciler is not None:
+                self.reconciler.cancel()
+                self.reconciler = None
+            self.streams.close()
+            self.flush()
+            if self.shards is not None:
+                self.shards.close()
+
+    def stop(self):
+        """Stops serving, from any thread."""
+        self.loop.call_soon_threadsafe(self.serving.cancel)
 
     def run(self):
-        ws = WebSocketApp(
-            self.api_url,
-            on_error=self.on_error,
-            on_open=self.on_open,
-            on_message=self.on_message,
-        )
         # tells to healthchecker that ingestion is ready
         (root_path / 'ready.txt').touch()
+        start_metrics_server()
 
-        return ws.run_forever()
+        try:
+            return asyncio.run(self.serve())
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            logging.info("Ingestion stopped")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+from os import environ
 import logging
 import sys
 
@@ -5,25 +6,29 @@ import sys
 logging.basicConfig(stream = sys.stdout,
                     filemode = "w",
                     format = "[%(asctime)s] – %(name)s – %(levelname)s: %(message)s",
-                    level = logging.DEBUG)
+                    level = environ.get("LOG_LEVEL", "DEBUG").upper())
+
+
+def debug_enabled() -> bool:
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
 
 
 class WsLogger:
-    def __init__(self, conn_id: str) -> None:
+    def __init__(self, conn_id: int) -> None:
         self.conn_id = conn_id
 
-    def info(self, message: str, subs_id: str = None):
+    def info(self, message: str, subs_id: int = None):
         subs_str = f"[{subs_id}]" if subs_id else ""
         logging.info(f"[{self.conn_id}]{subs_str}: {message}")
 
-    def warn(self, message: str, subs_id: str = None):
+    def warn(self, message: str, subs_id: int = None):
         subs_str = f"[{subs_id}]" if subs_id else ""
         logging.warning(f"[{self.conn_id}]{subs_str}: {message}")
 
-    def error(self, message: str, subs_id: str = None):
+    def error(self, message: str, subs_id: int = None):
         subs_str = f"[{subs_id}]" if subs_id else ""
         logging.error(f"[{self.conn_id}]{subs_str}: {message}")
 
-    def debug(self, message: str, subs_id: str = None):
+    def debug(self, message: str, subs_id: int = None):
         subs_str = f"[{subs_id}]" if subs_id else ""
         logging.debug(f"[{self.conn_id}]{subs_str}: {message}")
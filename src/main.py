@@ -1,93 +1,181 @@
 from os import environ
-import json
 import asyncio
-from datetime import datetime, timedelta
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+from fastapi import Depends, FastAPI, WebSocket, WebSocketDisconnect, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 
-from sql.models import Subscription, Connection
-from sql.data import list_subscriptions_from_connection, list_notifications_from_subscription, HEARTBEAT_LIMIT
+from sql.database import InstrumentedQueuePool
+from sql.models import Subscription, Connection, Notification
+from sql.data import list_subscriptions_from_connection, HEARTBEAT_LIMIT
+from sql.notify import Listener, NOTIFICATIONS_CHANNEL
+from hub import NotificationHub
 from logger.logger import WsLogger
 from enums import Symbol
+from metrics import ALERT_LATENCY, ACTIVE_WEBSOCKETS, NOTIFICATIONS_DELIVERED, measure_loop_lag
+import serialization
 
 app = FastAPI()
 
-
-def get_engine():
+# Notifications are fetched when the NOTIFY of new ones arrives, this poll is only a safety net.
+NOTIFICATION_POLL_INTERVAL = float(environ.get("NOTIFICATION_POLL_INTERVAL", 5))
+# All the subscriptions of the worker are heartbeated together, it must stay well below HEARTBEAT_LIMIT.
+SUBSCRIPTION_HEARTBEAT_INTERVAL = float(environ.get("SUBSCRIPTION_HEARTBEAT_INTERVAL", HEARTBEAT_LIMIT / 3))
+
+# Pool of the worker, shared by all its websockets. Each one holds a connection only while it queries, so the pool
+# bounds the concurrent queries rather than the clients. Saturation shows on /metrics: db_pool_checked_out against
+# db_pool_size + db_pool_max_overflow, db_pool_wait_seconds and db_pool_timeouts.
+DB_POOL_SIZE = int(environ.get("DB_POOL_SIZE", 20))
+DB_MAX_OVERFLOW = int(environ.get("DB_MAX_OVERFLOW", 0))
+DB_POOL_TIMEOUT = float(environ.get("DB_POOL_TIMEOUT", 30))
+# Threads running the blocking queries of the worker, off the event loop. More than the pool would only wait for
+# its connections.
+DB_THREADS = int(environ.get("DB_THREADS", DB_POOL_SIZE + DB_MAX_OVERFLOW))
+
+@lru_cache()
+def get_engine() -> Engine:
+    """The engine of the worker, created once and injected into every websocket."""
     db_credentials = environ.get("PSQL_CONN")
-    return create_engine(db_credentials, pool_size=20, max_overflow=0)
+    return create_engine(db_credentials, poolclass=InstrumentedQueuePool, pool_size=DB_POOL_SIZE,
+                         max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+
+@lru_cache()
+def get_executor() -> ThreadPoolExecutor:
+    """The threads of the worker for the database calls, shared by every websocket and the hub."""
+    return ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="webserver-db")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.loop_lag = asyncio.create_task(measure_loop_lag())
+    app.state.engine = get_engine()
+    app.state.executor = get_executor()
+    app.state.hub = NotificationHub(app.state.engine, NOTIFICATION_POLL_INTERVAL,
+                                    SUBSCRIPTION_HEARTBEAT_INTERVAL, app.state.executor)
+    app.state.hub.start()
+    # A single LISTEN connection for every websocket of this worker
+    app.state.listener = Listener(app.state.engine, {NOTIFICATIONS_CHANNEL: app.state.hub.wake})
+    app.state.listener.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    app.state.loop_lag.cancel()
+    await app.state.listener.close()
+    await app.state.hub.close()
+    app.state.executor.shutdown()
+    get_executor.cache_clear()
+    app.state.engine.dispose()
+    get_engine.cache_clear()
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 class WsHandler():
 
-    def __init__(self, websocket: WebSocket, engine) -> None:
+    def __init__(self, websocket: WebSocket, engine, hub: NotificationHub,
+                 executor: Optional[ThreadPoolExecutor] = None) -> None:
         self.websocket = websocket
         self.engine = engine
-        self.sessionlocal: sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-        conn = Connection()
-        session = self.sessionlocal()
-        session.add(conn)
-        session.commit()
-        self.conn_id = conn.id
+        self.hub = hub
+        # Queries block, they run on these threads and the loop keeps serving the other websockets
+        self.executor = executor
+        self.sessionlocal: sessionmaker = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                                       bind=self.engine)
+        self.conn_id = None
+        self.logger = None
+        self.queue = None
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def open(self):
+        """Registers the connection into the database and the hub."""
+        self.conn_id = await self.run_blocking(self.create_connection)
         self.logger = WsLogger(self.conn_id)
-        session.close()
+        # Notifications routed to this connection by the hub
+        self.queue = self.hub.register(self.conn_id)
 
-    async def check_notifications(self):
+    def create_connection(self) -> int:
+        conn = Connection()
         session = self.sessionlocal()
-        subs = list_subscriptions_from_connection(session, self.conn_id)
-
-        for sub in subs:
-            if sub.last_heartbeat < datetime.utcnow() - timedelta(seconds=HEARTBEAT_LIMIT/2):
-                sub.last_heartbeat = datetime.utcnow()
-
-                self.logger.debug("Subscription heartbeat updated", sub.id)
-            notifications = list_notifications_from_subscription(session, sub.id)
-            for notification in notifications:
-                message = json.dumps(notification.to_json())
+        try:
+            session.add(conn)
+            session.commit()
+        finally:
+            session.close()
+        return conn.id
+
+    async def send_notifications(self, notification: Notification):
+        """Sends the given notification and whatever else is queued for this connection."""
+        while True:
+            message = serialization.dumps(notification.to_json())
+            try:
                 await self.websocket.send_text(message)
-                self.logger.debug(message)
-                notification.finished_at = datetime.utcnow()
-            session.add_all(notifications)
-        session.commit()
-        session.close()
-
+            except Exception:
+                self.hub.release(notification)
+                raise
+            sent_at = datetime.utcnow()
+            self.hub.ack(notification)
+            NOTIFICATIONS_DELIVERED.inc()
+            ALERT_LATENCY.labels("delivery").observe((sent_at - notification.created_at).total_seconds())
+            if notification.event_at is not None:
+                ALERT_LATENCY.labels("end_to_end").observe((sent_at - notification.event_at).total_seconds())
+            self.logger.debug(message)
+            if self.queue.empty():
+                return
+            notification = self.queue.get_nowait()
 
     async def handle_received_message(self, data: str):
         # Check if it is a json
-        data = json.loads(data)
+        data = serialization.loads(data)
         # Only subscribes
         # TODO: Handle multiple commands on websockets
         data["threshold"] = float(data["threshold"])
-        session = self.sessionlocal()
-        subs = list_subscriptions_from_connection(session, self.conn_id)
-        self.logger.debug(f"previous subscriptions: {[json.dumps(sub.to_json()) for sub in subs]}")
 
         # Check if received symbol is valid
         if data["symbol"].lower() not in Symbol.__dict__.values():
-            error_res = json.dumps({"type": "error", "message": "symbol is not valid, check https://www.binance.com/api/v3/exchangeInfo to get the available symbols"})
+            error_res = serialization.dumps({"type": "error", "message": "symbol is not valid, check https://www.binance.com/api/v3/exchangeInfo to get the available symbols"})
             await self.websocket.send_text(error_res)
             return error_res
 
-        for sub in subs:
-            if sub.price_threshold == data["threshold"] and sub.symbol == data["symbol"]:
-                return
-
-        sub = Subscription(
-            symbol=data["symbol"],
-            connection_id=self.conn_id,
-            price_threshold=data["threshold"],
-        )
-        session.add(sub)
-        session.commit()
+        sub = await self.run_blocking(self.create_subscription, data["symbol"], data["threshold"])
+        if sub is None:
+            return
+        self.hub.subscribe(self.conn_id, sub.id)
 
         res = sub.to_json()
-        await self.websocket.send_text(json.dumps(res))
-        self.logger.info(json.dumps(res), subs_id=sub.id)
-        session.close()
+        await self.websocket.send_text(serialization.dumps(res))
+        self.logger.info(serialization.dumps(res), subs_id=sub.id)
         return res
 
+    def create_subscription(self, symbol: str, threshold: float) -> Optional[Subscription]:
+        """Returns the new subscription, None if the connection already has the same one."""
+        session = self.sessionlocal()
+        try:
+            subs = list_subscriptions_from_connection(session, self.conn_id)
+            self.logger.debug(f"previous subscriptions: {[serialization.dumps(sub.to_json()) for sub in subs]}")
+            for sub in subs:
+                if sub.price_threshold == threshold and sub.symbol == symbol:
+                    return None
+
+            sub = Subscription(symbol=symbol, connection_id=self.conn_id, price_threshold=threshold)
+            session.add(sub)
+            session.commit()
+            return sub
+        finally:
+            session.close()
+
     def close_websocket_session(self):
         session = self.sessionlocal()
         for conn in session.query(Connection).filter(Connection.id == self.conn_id).all():
@@ -99,27 +187,53 @@ class WsHandler():
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, engine: Engine = Depends(get_engine)):
     await websocket.accept()
 
-    handler = WsHandler(websocket, get_engine())
+    handler = WsHandler(websocket, engine, websocket.app.state.hub, websocket.app.state.executor)
+    await handler.open()
     logger = handler.logger
     logger.debug(handler.engine.url)
-    while True:
-        try:
-            data = await asyncio.wait_for(websocket.receive_text(), 0.5)
-            await handler.handle_received_message(data)
-        # Connection closed
-        except WebSocketDisconnect:
-            handler.close_websocket_session()
-            return
-        # No commands received, proceeds
-        except asyncio.TimeoutError:
-            logger.debug("No message received")
-        except Exception as e:
-            logger.error(e)
-            await websocket.send_text('Invalid json subscription message. e.g: {"symbol": "btcusdt", "threshold": "20356.11"}')
-            logger.info('Invalid json subscription message. e.g: {"symbol": "btcusdt", "threshold": "20356.11"}')
-
-        # Check the notification messages and consume them
-        await handler.check_notifications()
+    ACTIVE_WEBSOCKETS.inc()
+    receive = None
+    notified = None
+    try:
+        while True:
+            if receive is None:
+                receive = asyncio.ensure_future(websocket.receive_text())
+            if notified is None:
+                notified = asyncio.ensure_future(handler.queue.get())
+            # A command or a notification for this connection, whichever comes first
+            done, _ = await asyncio.wait({receive, notified}, return_when=asyncio.FIRST_COMPLETED)
+
+            if receive in done:
+                received, receive = receive, None
+                try:
+                    await handler.handle_received_message(received.result())
+                except WebSocketDisconnect:
+                    raise
+                except Exception as e:
+                    logger.error(e)
+                    await websocket.send_text('Invalid json subscription message. e.g: {"symbol": "btcusdt", "threshold": "20356.11"}')
+                    logger.info('Invalid json subscription message. e.g: {"symbol": "btcusdt", "threshold": "20356.11"}')
+
+            # Send the notifications routed to this connection
+            if notified in done:
+                received, notified = notified, None
+                await handler.send_notifications(received.result())
+    # Connection closed
+    except WebSocketDisconnect:
+        pass
+    # Connection lost while sending, the notification is already released
+    except Exception as e:
+        logger.error(f"Could not send to the connection: {e}")
+    finally:
+        if receive is not None:
+            receive.cancel()
+        # Already taken from the queue but not sent
+        if notified is not None and not notified.cancel():
+            handler.hub.release(notified.result())
+        handler.hub.unregister(handler.conn_id)
+        ACTIVE_WEBSOCKETS.dec()
+        # Whatever ended the connection, its subscriptions end with it
+        await handler.run_blocking(handler.close_websocket_session)
@@ -0,0 +1,81 @@
+"""
+    Prometheus metrics of the ingestion and the webserver.
+
+    Each process has its own registry: the webserver serves it on `/metrics`, the ingestion on an HTTP listener
+    of its own (INGESTION_METRICS_PORT).
+"""
+from os import environ
+import asyncio
+from typing import Set
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from logger.logger import logging
+
+INGESTION_METRICS_PORT = int(environ.get("INGESTION_METRICS_PORT", 9100))
+# Period of the event loop lag probe, in seconds.
+LOOP_LAG_INTERVAL = float(environ.get("LOOP_LAG_INTERVAL", 0.5))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Ingestion
+FRAMES_RECEIVED = Counter("ingestion_frames_received", "Trade frames received from the exchange", ["symbol"])
+TRADES_EVALUATED = Counter("ingestion_trades_evaluated", "Trades evaluated against the thresholds, once coalesced")
+CROSSINGS = Counter("ingestion_crossings", "Thresholds crossed, one notification each")
+ACTIVE_SUBSCRIPTIONS = Gauge("ingestion_subscriptions_active", "Live subscriptions mirrored by the ingestion")
+TICK_QUEUE_DEPTH = Gauge("ingestion_tick_queue_depth", "Trades received and waiting for evaluation")
+TICKS_COALESCED = Counter("ingestion_ticks_coalesced", "Trades merged into the low/high/last of their symbol "
+                                                       "because too many were pending for it")
+NOTIFICATIONS_INSERTED = Counter("notifications_inserted", "Notifications written by the ingestion")
+NOTIFICATIONS_DROPPED = Counter("notifications_dropped", "Notifications the ingestion could not write: buffer full "
+                                                         "or batch failing every retry")
+
+# Webserver
+ACTIVE_WEBSOCKETS = Gauge("webserver_websockets_active", "Client websocket connections open")
+NOTIFICATIONS_DELIVERED = Counter("notifications_delivered", "Notifications sent to the client websockets")
+DELIVERY_QUEUE_DEPTH = Gauge("webserver_delivery_queue_depth", "Notifications routed to the websockets and not "
+                                                               "acked yet")
+
+# Both
+DB_POOL_CHECKOUTS = Counter("db_pool_checkouts", "Connections checked out of the SQLAlchemy pools")
+DB_POOL_WAIT = Histogram("db_pool_wait_seconds", "Time waited for a connection of the SQLAlchemy pools",
+                         buckets=LATENCY_BUCKETS)
+# Saturation of the process pool: checked out reaching size + overflow means checkouts wait, then time out
+DB_POOL_SIZE = Gauge("db_pool_size", "Connections kept by the SQLAlchemy pool of the process")
+DB_POOL_MAX_OVERFLOW = Gauge("db_pool_max_overflow", "Connections the SQLAlchemy pool may open beyond its size")
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections of the SQLAlchemy pool currently in use")
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts", "Checkouts that timed out waiting for a free connection")
+EVENT_LOOP_LAG = Histogram("event_loop_lag_seconds", "Delay of the event loop in running a ready callback",
+                           buckets=LATENCY_BUCKETS)
+
+# Alerts from the trade on the exchange to the message on the client websocket, per stage:
+# - receipt: trade event time to frame receipt by the ingestion (includes the clock skew with the exchange)
+# - detection: frame receipt to crossing detection, observed once per crossing trade
+# - commit: crossing detection to notification commit, per notification
+# - delivery: notification insert to websocket.send_text by the webserver, per notification
+# - end_to_end: trade event time to websocket.send_text, per notification
+ALERT_LATENCY = Histogram("alert_latency_seconds", "Latency of the alerts per stage", ["stage"],
+                          buckets=LATENCY_BUCKETS)
+
+serving: Set[int] = set()
+
+
+def start_metrics_server(port: int = INGESTION_METRICS_PORT):
+    """Serves the metrics over HTTP on a thread of its own, once per process and port. Port 0 turns it off."""
+    if not port or port in serving:
+        return
+    try:
+        start_http_server(port)
+        serving.add(port)
+        logging.info(f"Serving metrics on port {port}")
+    except OSError as e:
+        logging.error(f"Could not serve metrics on port {port}: {e}")
+
+
+async def measure_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Sleeps `interval` over and over, the time it oversleeps is the time the loop was busy with something else."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from sql.data import list_current_subscriptions, list_subscriptions_changed_since, db_utcnow, HEARTBEAT_LIMIT
+from sql.models import Subscription
+from thresholds import ThresholdIndex
+from logger.logger import logging
+
+# updated_at is the start of the transaction of the change, so a change can become visible a bit after it.
+# Every delta re-reads this many seconds before the watermark; applying a change twice is harmless.
+WATERMARK_OVERLAP = 10
+# Reload everything once in a while anyway, in case a change was committed later than the overlap.
+FULL_REFRESH_PERIOD = 300
+
+
+class SubscriptionChanges(NamedTuple):
+    # On the database clock, as updated_at
+    fetched_at: datetime
+    # All the live subscriptions when True, only the changed ones otherwise
+    full: bool
+    subs: List[Subscription]
+
+
+class SubscriptionMirror:
+    """
+        Local copy of the live subscriptions of the ingestion.
+
+        It is loaded once and then only applies the subscriptions created or finished since the last refresh (the
+        watermark), and the ones whose heartbeat expired meanwhile. Heartbeats are not read, so a refresh costs the
+        churn since the previous one, not the number of live subscriptions.
+
+        `fetch` only reads the database and may run on a worker thread, `update` applies what it returned and
+        belongs to the thread evaluating the prices.
+    """
+
+    def __init__(self, sessionlocal: sessionmaker) -> None:
+        self.sessionlocal = sessionlocal
+        self.thresholds = ThresholdIndex()
+        self.watermark: Optional[datetime] = None
+        self.loaded_at: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return len(self.thresholds)
+
+    def refresh(self):
+        self.update(self.fetch())
+
+    def fetch(self) -> SubscriptionChanges:
+        session = self.sessionlocal()
+        try:
+            now = session.execute(select(db_utcnow())).scalar()
+            full = self.loaded_at is None or self.loaded_at < now - timedelta(seconds=FULL_REFRESH_PERIOD)
+            if full:
+                subs = list_current_subscriptions(session)
+            else:
+                since = self.watermark - timedelta(seconds=WATERMARK_OVERLAP)
+                subs = list_subscriptions_changed_since(session, since, now)
+        finally:
+            session.close()
+        return SubscriptionChanges(now, full, subs)
+
+    def update(self, changes: SubscriptionChanges):
+        if changes.full:
+            self.load(changes.subs)
+            self.loaded_at = changes.fetched_at
+        else:
+            self.apply(changes.subs, changes.fetched_at)
+        self.watermark = changes.fetched_at
+        logging.debug(f"Subscriptions {'loaded' if changes.full else 'refreshed'}: "
+                      f"{len(changes.subs)} rows, {len(self)} live")
+
+    def load(self, subs: List[Subscription]):
+        thresholds = ThresholdIndex()
+        for sub in subs:
+            thresholds.add(sub.id, sub.symbol, sub.price_threshold)
+
+        self.thresholds = thresholds
+
+    def apply(self, subs: List[Subscription], now: datetime):
+        limit = now - timedelta(seconds=HEARTBEAT_LIMIT)
+        for sub in subs:
+            if sub.finished_at is not None or sub.last_heartbeat <= limit:
+                self.thresholds.remove(sub.id)
+            else:
+                self.thresholds.add(sub.id, sub.symbol, sub.price_threshold)
+
+    def symbols(self) -> Set[str]:
+        return self.thresholds.symbols()
+
+    def crossed(self, symbol: str, previous_price: float, current_price: float) -> List[int]:
+        return self.thresholds.crossed(symbol, previous_price, current_price)
+
+    def crossings(self, symbol: str, previous_price: Optional[float],
+                  prices: Sequence[float]) -> List[Tuple[int, List[int]]]:
+        return self.thresholds.crossings(symbol, previous_price, prices)
@@ -0,0 +1,72 @@
+"""
+    Partition maintenance of the `notifications` table.
+
+    Creates the daily partitions of the coming days and drops the ones past the retention, whole, instead of
+    DELETE scans. Runs every RETENTION_INTERVAL seconds:
+
+        python src/retention.py [--once]
+"""
+from os import environ
+import argparse
+import time
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+
+from sql.partitions import create_partitions, drop_partitions
+from logger.logger import logging
+
+# Days of notifications kept, today included
+NOTIFICATION_RETENTION_DAYS = int(environ.get("NOTIFICATION_RETENTION_DAYS", 7))
+# Partitions created in advance, today included, so the rows never land in the default partition
+NOTIFICATION_PARTITIONS_AHEAD = int(environ.get("NOTIFICATION_PARTITIONS_AHEAD", 3))
+RETENTION_INTERVAL = float(environ.get("RETENTION_INTERVAL", 3600))
+
+# Serializes the maintenance when more than one job runs
+RETENTION_LOCK = 0x6e6f7469
+
+
+def apply_retention(engine: Engine, today: Optional[date] = None, retention_days: int = NOTIFICATION_RETENTION_DAYS,
+                    ahead: int = NOTIFICATION_PARTITIONS_AHEAD) -> Tuple[List[str], List[str]]:
+    """
+        Returns the partitions created and dropped. Creating and dropping run in their own transaction, one failing
+        doesn't stop the other.
+    """
+    today = today or datetime.utcnow().date()
+    created, dropped = [], []
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": RETENTION_LOCK})
+            created = create_partitions(connection, today, ahead)
+    except Exception as e:
+        logging.error(f"Could not create the notification partitions: {e}")
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": RETENTION_LOCK})
+        dropped = drop_partitions(connection, today - timedelta(days=retention_days - 1))
+
+    if created or dropped:
+        logging.info(f"Notification partitions created: {created}, dropped: {dropped}")
+    return created, dropped
+
+
+def run(engine: Engine, interval: float = RETENTION_INTERVAL):
+    while True:
+        try:
+            apply_retention(engine)
+        except Exception as e:
+            logging.error(f"Could not apply the notification retention: {e}")
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--once", action="store_true", help="apply the retention once and exit")
+    args = parser.parse_args()
+
+    engine = create_engine(environ.get("PSQL_CONN"))
+    if args.once:
+        apply_retention(engine)
+    else:
+        run(engine)
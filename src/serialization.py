@@ -0,0 +1,24 @@
+"""
+    JSON used by both the ingestion and the webserver: orjson when it is installed, the standard library otherwise.
+"""
+import json
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        return orjson.dumps(obj, default=default).decode()
+else:
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    def dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        return json.dumps(obj, separators=(",", ":"), default=default)
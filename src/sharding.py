@@ -0,0 +1,136 @@
+from os import environ
+from hashlib import blake2b
+from time import monotonic
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from sql.data import (register_worker, heartbeat_worker, reap_expired_workers, list_live_workers, finish_worker,
+                      worker_application_name, WORKER_LEASE)
+from logger.logger import logging
+
+INGESTION_SHARDING = environ.get("INGESTION_SHARDING", "false").lower() == "true"
+
+
+def symbol_lock_key(symbol: str) -> int:
+    # pg advisory locks take a signed bigint
+    return int.from_bytes(blake2b(symbol.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+def symbol_owner(symbol: str, workers: List[str]) -> str:
+    """Rendezvous hashing: when a worker joins or leaves, only the symbols it wins or loses move."""
+    return max(workers, key=lambda worker: blake2b(f"{worker}:{symbol}".encode(), digest_size=8).digest())
+
+
+class ShardCoordinator:
+    """
+        Splits the subscribed symbols among the ingestion processes sharing the database.
+
+        Every process registers itself in `ingestion_workers` and heartbeats there. The owner of a symbol is
+        picked by rendezvous hashing over the live workers, and streaming it requires a Postgres advisory lock,
+        held by a dedicated connection, so two processes never evaluate the same symbol.
+
+        A worker without heartbeat for WORKER_LEASE seconds is reaped by the others: its row is deleted and its
+        lock connection terminated, so its symbols fail over within WORKER_LEASE plus one reconciliation.
+        All methods are blocking and meant to run off the event loop, one at a time.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        self.engine = engine
+        self.connection: Optional[Connection] = None
+        self.worker_id: Optional[str] = None
+        self.workers: List[str] = []
+        self.workers_at = 0.0
+        self.owners: Dict[str, str] = {}
+        self.held: Set[str] = set()
+        self.owned: Set[str] = set()
+
+    def start(self):
+        connection = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        self.worker_id = register_worker(connection)
+        # Lets the other workers find and end this connection, and its locks, once our lease expires
+        connection.execute(text(f"SET application_name = '{worker_application_name(self.worker_id)}'"))
+        self.connection = connection
+        self.workers_at = 0.0
+        logging.info(f"Ingestion worker {self.worker_id} registered")
+
+    def refresh_workers(self):
+        if not heartbeat_worker(self.connection, self.worker_id):
+            # Reaped while stalled, our locks are gone with the old connection
+            raise RuntimeError(f"Ingestion worker {self.worker_id} lost its lease")
+
+        reaped = reap_expired_workers(self.connection)
+        if reaped:
+            logging.warning(f"Reaped expired ingestion workers: {reaped}")
+
+        workers = list_live_workers(self.connection)
+        if workers != self.workers:
+            logging.info(f"Ingestion workers: {workers}")
+            self.workers = workers
+            self.owners = {}
+        self.workers_at = monotonic()
+
+    def claim(self, symbols: Set[str]) -> Set[str]:
+        """Locks the symbols this worker owns among `symbols`, returns the ones it may stream."""
+        try:
+            if self.connection is None:
+                self.start()
+            if monotonic() - self.workers_at > WORKER_LEASE / 3:
+                self.refresh_workers()
+
+            self.owned = {symbol for symbol in symbols if self.owner(symbol) == self.worker_id}
+            for symbol in self.owned - self.held:
+                if self.lock(symbol):
+                    self.held.add(symbol)
+        except Exception as e:
+            logging.error(e)
+            self.reset()
+        # Symbols no longer owned are left out, release unlocks them once they are unsubscribed
+        return self.held & self.owned
+
+    def release(self):
+        """Unlocks the symbols no longer owned, once they are not streamed anymore."""
+        try:
+            for symbol in self.held - self.owned:
+                self.unlock(symbol)
+                self.held.discard(symbol)
+        except Exception as e:
+            logging.error(e)
+            self.reset()
+
+    def owner(self, symbol: str) -> str:
+        owner = self.owners.get(symbol)
+        if owner is None:
+            owner = self.owners[symbol] = symbol_owner(symbol, self.workers)
+        return owner
+
+    def lock(self, symbol: str) -> bool:
+        return self.connection.execute(select(func.pg_try_advisory_lock(symbol_lock_key(symbol)))).scalar()
+
+    def unlock(self, symbol: str):
+        self.connection.execute(select(func.pg_advisory_unlock(symbol_lock_key(symbol))))
+
+    def reset(self):
+        """Drops the connection, and every lock with it, registering again on the next claim."""
+        if self.connection is not None:
+            try:
+                self.connection.invalidate()
+            except Exception as e:
+                logging.error(e)
+        self.connection = None
+        self.worker_id = None
+        self.workers = []
+        self.owners = {}
+        self.held = set()
+        self.owned = set()
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            finish_worker(self.connection, self.worker_id)
+        except Exception as e:
+            logging.error(e)
+        # Invalidated rather than returned to the pool, which would keep the locks and the application_name
+        self.reset()
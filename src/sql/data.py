@@ -1,10 +1,31 @@
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, List
+from sqlalchemy import and_, or_, func, select, update, delete, insert, text, tuple_
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm import Session
 
-from .models import Subscription, Notification
+from .models import Subscription, Notification, IngestionWorker
 
 HEARTBEAT_LIMIT = 60
+# Pending notifications older than this many seconds are not delivered anymore. Bounding created_at also prunes
+# the queries to the latest partitions of `notifications`.
+NOTIFICATION_DELIVERY_WINDOW = 24 * 60 * 60
+# Notifications claimed at most by statement, the rest is claimed right after.
+NOTIFICATION_CLAIM_BATCH = 1000
+# Seconds a claim lasts without ack. Past it the notification is pending again, e.g. when the webserver worker
+# that claimed it died before sending it.
+NOTIFICATION_CLAIM_LEASE = 60
+# Seconds without heartbeat before an ingestion worker is considered dead and its symbols move to the others.
+WORKER_LEASE = 10
+
+
+def db_utcnow():
+    # Leases are compared on the database clock, the workers may run on different hosts.
+    return func.timezone("utc", func.now())
+
+
+def worker_application_name(worker_id: str) -> str:
+    return f"ingestion:{worker_id}"
 
 
 def list_current_sub_symbols(session: Session) -> List[str]:
@@ -20,6 +41,35 @@ def list_current_sub_symbols(session: Session) -> List[str]:
     ]
 
 
+def list_current_subscriptions(session: Session) -> List[Subscription]:
+    result = session.query(Subscription) \
+                .filter(Subscription.finished_at == None) \
+                .filter(Subscription.last_heartbeat > datetime.utcnow() - timedelta(seconds=HEARTBEAT_LIMIT)) \
+                .all()
+
+    return result
+
+
+def list_subscriptions_changed_since(session: Session, since: datetime, now: datetime) -> List[Subscription]:
+    """
+        Created or finished after `since`, whatever their current state, and the live ones whose heartbeat expired
+        between `since` and `now`. Heartbeats alone don't count as a change, the delta stays as small as the churn.
+    """
+    limit = timedelta(seconds=HEARTBEAT_LIMIT)
+    result = session.query(Subscription) \
+                .filter(or_(
+                    Subscription.updated_at > since,
+                    and_(
+                        Subscription.finished_at == None,
+                        Subscription.last_heartbeat > since - limit,
+                        Subscription.last_heartbeat <= now - limit,
+                    ),
+                )) \
+                .all()
+
+    return result
+
+
 def list_current_subscriptions_from_symbol(session: Session, symbol: str) -> List[Subscription]:
     result = session.query(Subscription) \
                 .filter(Subscription.finished_at == None) \
@@ -43,7 +93,124 @@ def list_subscriptions_from_connection(session: Session, conn_id: int) -> List[S
 def list_notifications_from_subscription(session: Session, sub_id: int) -> List[Notification]:
     result = session.query(Notification) \
                 .filter(Notification.finished_at == None) \
+                .filter(Notification.created_at > datetime.utcnow() - timedelta(seconds=NOTIFICATION_DELIVERY_WINDOW)) \
                 .filter(Notification.subscription_id == sub_id) \
                 .all()
 
     return result
+
+
+def heartbeat_subscriptions(session: Session, sub_ids: List[int]) -> int:
+    """Heartbeats the given subscriptions in one UPDATE, the finished or already expired ones stay as they are."""
+    now = datetime.utcnow()
+    result = session.execute(
+        update(Subscription)
+        .where(Subscription.id.in_(sub_ids))
+        .where(Subscription.finished_at == None)
+        .where(Subscription.last_heartbeat > now - timedelta(seconds=HEARTBEAT_LIMIT))
+        .values(last_heartbeat=now)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def claim_pending_notifications(session: Session, sub_ids: List[int],
+                                limit: int = NOTIFICATION_CLAIM_BATCH) -> List[Notification]:
+    """
+        Claims up to `limit` pending notifications of the given subscriptions and returns them, oldest first, with
+        a single UPDATE ... RETURNING setting their claimed_at. A claim lasts NOTIFICATION_CLAIM_LEASE seconds: the
+        notification is finished with `finish_notifications` once sent, given back with `release_notifications`,
+        or claimable again when its lease expires.
+
+        The rows are picked FOR UPDATE SKIP LOCKED: concurrent claims, e.g. of other webserver replicas, split the
+        pending rows instead of waiting for each other's locks.
+    """
+    now = datetime.utcnow()
+    since = now - timedelta(seconds=NOTIFICATION_DELIVERY_WINDOW)
+    pending = select(Notification.id, Notification.created_at) \
+        .where(Notification.finished_at == None) \
+        .where(or_(
+            Notification.claimed_at == None,
+            Notification.claimed_at < now - timedelta(seconds=NOTIFICATION_CLAIM_LEASE),
+        )) \
+        .where(Notification.created_at > since) \
+        .where(Notification.subscription_id.in_(sub_ids)) \
+        .order_by(Notification.created_at) \
+        .limit(limit) \
+        .with_for_update(skip_locked=True)
+    # created_at again, so the UPDATE is pruned to the latest partitions as well
+    claim = update(Notification) \
+        .where(tuple_(Notification.id, Notification.created_at).in_(pending)) \
+        .where(Notification.created_at > since) \
+        .values(claimed_at=now) \
+        .returning(*Notification.__table__.columns)
+    result = session.execute(
+        select(Notification).from_statement(claim).execution_options(populate_existing=True)
+    ).scalars().all()
+
+    return sorted(result, key=lambda notification: notification.created_at)
+
+
+def release_notifications(session: Session, released: List[Dict]):
+    """Makes claimed notifications pending again in a single executemany, each one a dict of its primary key."""
+    session.bulk_update_mappings(Notification, [{**keys, "claimed_at": None} for keys in released])
+
+
+def finish_notifications(session: Session, acked: List[Dict]) -> int:
+    """Finishes the sent notifications in a single UPDATE, each one a dict of its primary key."""
+    result = session.execute(
+        update(Notification)
+        .where(tuple_(Notification.id, Notification.created_at).in_(
+            [(keys["id"], keys["created_at"]) for keys in acked]
+        ))
+        # Prunes the UPDATE to the partitions of the acked notifications
+        .where(Notification.created_at >= min(keys["created_at"] for keys in acked))
+        .values(finished_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def register_worker(connection: Connection) -> str:
+    table = IngestionWorker.__table__
+    result = connection.execute(insert(table).values(created_at=db_utcnow(), last_heartbeat=db_utcnow()))
+    return result.inserted_primary_key[0]
+
+
+def heartbeat_worker(connection: Connection, worker_id: str) -> bool:
+    table = IngestionWorker.__table__
+    result = connection.execute(update(table).where(table.c.id == worker_id).values(last_heartbeat=db_utcnow()))
+    return result.rowcount == 1
+
+
+def reap_expired_workers(connection: Connection) -> List[str]:
+    """Removes the workers without heartbeat and ends their lock connections, releasing their symbols."""
+    table = IngestionWorker.__table__
+    expired = connection.execute(
+        delete(table)
+        .where(table.c.last_heartbeat < db_utcnow() - timedelta(seconds=WORKER_LEASE))
+        .returning(table.c.id)
+    ).scalars().all()
+
+    for worker_id in expired:
+        connection.execute(
+            text("SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE application_name = :name"),
+            {"name": worker_application_name(worker_id)},
+        )
+    return expired
+
+
+def list_live_workers(connection: Connection) -> List[str]:
+    table = IngestionWorker.__table__
+    result = connection.execute(
+        select(table.c.id)
+        .where(table.c.last_heartbeat >= db_utcnow() - timedelta(seconds=WORKER_LEASE))
+        .order_by(table.c.id)
+    ).scalars().all()
+
+    return result
+
+
+def finish_worker(connection: Connection, worker_id: str):
+    table = IngestionWorker.__table__
+    connection.execute(delete(table).where(table.c.id == worker_id))
@@ -1,3 +1,36 @@
+from time import perf_counter
+
+from sqlalchemy.exc import TimeoutError
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+
+from metrics import (
+    DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUTS, DB_POOL_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUTS, DB_POOL_WAIT,
+)
 
 Base = declarative_base()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+        QueuePool counting the checkouts and how long each one waited for a connection, opening included.
+
+        The saturation gauges follow the last pool created, there is one per process.
+    """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kw)
+        DB_POOL_SIZE.set(pool_size)
+        DB_POOL_MAX_OVERFLOW.set(max(max_overflow, 0))
+        DB_POOL_CHECKED_OUT.set_function(self.checkedout)
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUTS.inc()
+            DB_POOL_WAIT.observe(perf_counter() - start)
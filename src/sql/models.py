@@ -1,10 +1,13 @@
 import datetime
 from uuid import uuid4
 
-from sqlalchemy import (Column, String, DateTime, ForeignKey, Integer, Float)
+from sqlalchemy import (Column, String, DateTime, ForeignKey, BigInteger, Integer, Float, Index, DDL, event, text)
 from sqlalchemy.orm import relationship
 from .database import Base
+from .notify import NOTIFICATIONS_TRIGGER, SUBSCRIPTIONS_TRIGGER
+from .partitions import DEFAULT_PARTITION_DDL
 
+# Only the ingestion workers still use it, their ids are hashed with the symbols to shard them.
 def uuid_str() -> str:
     return uuid4().hex[:8]
 
@@ -12,7 +15,7 @@ def uuid_str() -> str:
 class Connection(Base):
     __tablename__ = "connections"
 
-    id = Column(String(36), primary_key=True, unique=True, default=uuid_str)
+    id = Column(BigInteger, primary_key=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     finished_at = Column(DateTime, nullable=True)
 
@@ -24,22 +27,34 @@ class Connection(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
-
-    id = Column(String(36), primary_key=True, unique=True, default=uuid_str)
-    connection_id = Column(String(36), ForeignKey("connections.id"), nullable=False)
+    __table_args__ = (
+        # Live subscriptions, by symbol for the ingestion and by connection for the webserver
+        Index("ix_subscriptions_live_symbol", "symbol", "last_heartbeat", postgresql_where=text("finished_at IS NULL")),
+        Index("ix_subscriptions_live_connection", "connection_id", "last_heartbeat",
+              postgresql_where=text("finished_at IS NULL")),
+        # Changes since the watermark of the ingestion mirror: created or finished, and expired while live
+        Index("ix_subscriptions_updated_at", "updated_at"),
+        Index("ix_subscriptions_last_heartbeat", "last_heartbeat", postgresql_where=text("finished_at IS NULL")),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    connection_id = Column(BigInteger, ForeignKey("connections.id"), nullable=False)
     symbol = Column(String, nullable=False)
     price_threshold = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
     last_heartbeat = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
     finished_at = Column(DateTime, nullable=True)
+    # Set by SUBSCRIPTIONS_UPDATED_AT on create and finish only, heartbeats leave it alone
+    updated_at = Column(DateTime, nullable=False, server_default=text("timezone('utc', now())"))
 
     def __repr__(self):
         return f"Subscription(id={self.id!r}, symbol={self.symbol!r}, price_threshold={self.price_threshold!r} created_at={self.created_at!r}, finished_at={self.finished_at!r})"
 
     def to_json(self):
         return {
-            "id": self.id,
-            "connection_id": self.connection_id,
+            # Ids are BIGSERIAL, the clients keep getting strings
+            "id": str(self.id),
+            "connection_id": str(self.connection_id),
             "symbol": self.symbol,
             "price_threshold": self.price_threshold,
             "created_at": self.created_at.isoformat(),
@@ -47,27 +62,74 @@ class Subscription(Base):
         }
 
 
+# On the database clock, like the watermark of the ingestion mirror
+SUBSCRIPTIONS_UPDATED_AT = DDL("""
+CREATE OR REPLACE FUNCTION touch_subscriptions() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := timezone('utc', now());
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER subscriptions_updated_at BEFORE INSERT OR UPDATE OF finished_at ON subscriptions
+FOR EACH ROW EXECUTE FUNCTION touch_subscriptions();
+""")
+
+# Lets the ingestion reconcile its streams right away
+event.listen(Subscription.__table__, "after_create", SUBSCRIPTIONS_TRIGGER)
+event.listen(Subscription.__table__, "after_create", SUBSCRIPTIONS_UPDATED_AT)
+
+
 class Notification(Base):
     __tablename__ = "notifications"
-
-    id = Column(String(36), primary_key=True, unique=True, default=uuid_str)
-    subscription_id = Column(String(36), ForeignKey("subscriptions.id"), nullable=False)
+    __table_args__ = (
+        # Notifications waiting for delivery, by subscription
+        Index("ix_notifications_pending", "subscription_id", "created_at",
+              postgresql_where=text("finished_at IS NULL")),
+        # Daily partitions, see sql.partitions. The partition key has to be part of the primary key.
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    subscription_id = Column(BigInteger, ForeignKey("subscriptions.id"), nullable=False)
     symbol = Column(String, nullable=False)
     message = Column(String, nullable=False)
     order_ref = Column(Integer, nullable=False)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, primary_key=True, default=datetime.datetime.utcnow)
     finished_at = Column(DateTime, nullable=True)
+    # Last claim by a webserver worker, it lapses after NOTIFICATION_CLAIM_LEASE seconds without finished_at.
+    claimed_at = Column(DateTime, nullable=True)
+    # Trade event time on the exchange, then receipt of its frame and crossing detection by the ingestion.
+    event_at = Column(DateTime, nullable=True)
+    received_at = Column(DateTime, nullable=True)
+    detected_at = Column(DateTime, nullable=True)
 
     def __repr__(self):
         return f"Notification(id={self.id!r}, symbol={self.symbol!r}, created_at={self.created_at!r}, finished_at={self.finished_at!r})"
 
     def to_json(self):
         return {
-            "id": self.id,
-            "subscription_id": self.subscription_id,
+            "id": str(self.id),
+            "subscription_id": str(self.subscription_id),
             "symbol": self.symbol,
             "message": self.message,
             "order_ref": self.order_ref,
             "created_at": self.created_at.isoformat(),
             "finished_at": self.finished_at.isoformat() if self.finished_at else None,
         }
+
+
+# Wakes up the webserver connections concerned by new notifications
+event.listen(Notification.__table__, "after_create", NOTIFICATIONS_TRIGGER)
+event.listen(Notification.__table__, "after_create", DEFAULT_PARTITION_DDL)
+
+
+class IngestionWorker(Base):
+    __tablename__ = "ingestion_workers"
+
+    id = Column(String(36), primary_key=True, unique=True, default=uuid_str)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    last_heartbeat = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"IngestionWorker(id={self.id!r}, created_at={self.created_at!r}, last_heartbeat={self.last_heartbeat!r})"
@@ -0,0 +1,134 @@
+import asyncio
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import DDL
+from sqlalchemy.engine import Engine
+
+from logger.logger import logging
+
+NOTIFICATIONS_CHANNEL = "notifications"
+SUBSCRIPTIONS_CHANNEL = "subscriptions"
+# NOTIFY payloads are limited to 8000 bytes.
+MAX_PAYLOAD = 7900
+
+# One NOTIFY per INSERT statement, with the ids of the connections to wake up, comma separated.
+# An empty payload means every connection, when the ids don't fit.
+NOTIFICATIONS_TRIGGER = DDL(f"""
+CREATE OR REPLACE FUNCTION notify_notifications() RETURNS trigger AS $$
+DECLARE
+    payload text;
+BEGIN
+    SELECT string_agg(DISTINCT s.connection_id::text, ',') INTO payload
+    FROM inserted i JOIN subscriptions s ON s.id = i.subscription_id;
+    IF payload IS NOT NULL THEN
+        IF length(payload) > {MAX_PAYLOAD} THEN
+            payload := '';
+        END IF;
+        PERFORM pg_notify('{NOTIFICATIONS_CHANNEL}', payload);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notifications_notify AFTER INSERT ON notifications
+REFERENCING NEW TABLE AS inserted
+FOR EACH STATEMENT EXECUTE FUNCTION notify_notifications();
+""")
+
+# One NOTIFY per statement creating or finishing subscriptions, heartbeats don't touch finished_at.
+SUBSCRIPTIONS_TRIGGER = DDL(f"""
+CREATE OR REPLACE FUNCTION notify_subscriptions() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{SUBSCRIPTIONS_CHANNEL}', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER subscriptions_notify AFTER INSERT OR UPDATE OF finished_at ON subscriptions
+FOR EACH STATEMENT EXECUTE FUNCTION notify_subscriptions();
+""")
+
+
+class Listener:
+    """
+        One LISTEN connection per process, handing the NOTIFY payloads of its channels to callbacks.
+
+        The connection is watched by the event loop with add_reader, callbacks run on the loop. It reconnects
+        after `retry` seconds when lost, and every callback gets an empty payload once (re)connected, since
+        anything may have been missed meanwhile.
+    """
+
+    def __init__(self, engine: Engine, callbacks: Dict[str, Callable[[str], None]], retry: float = 1.0) -> None:
+        self.engine = engine
+        self.callbacks = callbacks
+        self.retry = retry
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                connection = await loop.run_in_executor(None, self.connect)
+            except Exception as e:
+                logging.error(f"Could not LISTEN to {list(self.callbacks)}: {e}")
+                await asyncio.sleep(self.retry)
+                continue
+
+            lost = loop.create_future()
+            fileno = connection.dbapi_connection.fileno()
+            loop.add_reader(fileno, self.receive, connection.dbapi_connection, lost)
+            try:
+                self.dispatch_all("")
+                await lost
+            except Exception as e:
+                logging.error(f"LISTEN connection lost: {e}")
+            finally:
+                loop.remove_reader(fileno)
+                connection.close()
+            await asyncio.sleep(self.retry)
+
+    def connect(self):
+        # Out of the pool for good: it stays in LISTEN and autocommit
+        connection = self.engine.raw_connection()
+        connection.detach()
+        connection.dbapi_connection.autocommit = True
+        cursor = connection.dbapi_connection.cursor()
+        for channel in self.callbacks:
+            cursor.execute(f"LISTEN {channel}")
+        cursor.close()
+        return connection
+
+    def receive(self, dbapi_connection, lost: asyncio.Future):
+        try:
+            dbapi_connection.poll()
+        except Exception as e:
+            if not lost.done():
+                lost.set_exception(e)
+            return
+
+        while dbapi_connection.notifies:
+            notify = dbapi_connection.notifies.pop(0)
+            self.dispatch(notify.channel, notify.payload)
+
+    def dispatch(self, channel: str, payload: str):
+        try:
+            self.callbacks[channel](payload)
+        except Exception as e:
+            logging.error(f"Could not handle NOTIFY {channel}: {e}")
+
+    def dispatch_all(self, payload: str):
+        for channel in self.callbacks:
+            self.dispatch(channel, payload)
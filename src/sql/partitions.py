@@ -0,0 +1,94 @@
+from datetime import date, datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import DDL, text
+from sqlalchemy.engine import Connection
+
+from logger.logger import logging
+
+# `notifications` is range partitioned by created_at, one partition per UTC day. The default partition only
+# catches the rows of days without a partition yet, the retention job creates them ahead of time.
+PARTITIONED_TABLE = "notifications"
+PARTITION_PREFIX = f"{PARTITIONED_TABLE}_p"
+DEFAULT_PARTITION = f"{PARTITIONED_TABLE}_default"
+
+DEFAULT_PARTITION_DDL = DDL(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARTITIONED_TABLE} DEFAULT")
+
+
+def partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def list_partitions(connection: Connection) -> Dict[str, date]:
+    """The daily partitions of `notifications`, by name, the default one left out."""
+    names = connection.execute(
+        text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+             "WHERE i.inhparent = CAST(:table AS regclass)"),
+        {"table": PARTITIONED_TABLE},
+    ).scalars().all()
+
+    return {
+        name: datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m%d").date()
+        for name in names
+        if name.startswith(PARTITION_PREFIX)
+    }
+
+
+def create_partitions(connection: Connection, start: date, days: int) -> List[str]:
+    """
+        Creates the missing partitions of the `days` days from `start`, each one in its own SAVEPOINT: a partition
+        that can't be created is logged and skipped, the others are created anyway.
+    """
+    existing = list_partitions(connection)
+    created = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        name = partition_name(day)
+        if name in existing:
+            continue
+        try:
+            with connection.begin_nested():
+                create_partition(connection, name, day)
+        except Exception as e:
+            logging.error(f"Could not create the notification partition {name}: {e}")
+            continue
+        created.append(name)
+    return created
+
+
+def create_partition(connection: Connection, name: str, day: date):
+    bounds = {"lower": day, "upper": day + timedelta(days=1)}
+    values = f"FOR VALUES FROM ('{bounds['lower'].isoformat()}') TO ('{bounds['upper'].isoformat()}')"
+    caught = connection.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper)"),
+        bounds,
+    ).scalar()
+    if not caught:
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF {PARTITIONED_TABLE} {values}"))
+        return
+
+    # The default partition caught rows of that day, e.g. on a database created without partitions or after the job
+    # was down for longer than the partitions ahead. A partition can't be created over them, they are moved to a
+    # table that is attached once filled.
+    connection.execute(text(
+        f"CREATE TABLE {name} (LIKE {PARTITIONED_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+    ))
+    connection.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper "
+        f"RETURNING *) INSERT INTO {name} SELECT * FROM moved"
+    ), bounds)
+    connection.execute(text(f"ALTER TABLE {PARTITIONED_TABLE} ATTACH PARTITION {name} {values}"))
+
+
+def drop_partitions(connection: Connection, before: date) -> List[str]:
+    """Drops the partitions of the days before `before` whole, and deletes the rows as old from the default one."""
+    dropped = []
+    for name, day in sorted(list_partitions(connection).items(), key=lambda item: item[1]):
+        if day >= before:
+            continue
+        connection.execute(text(f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {name}"))
+        connection.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+
+    connection.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE created_at < :before"), {"before": before})
+    return dropped
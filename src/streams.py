@@ -0,0 +1,196 @@
+from os import environ
+from math import ceil
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import websockets
+
+from logger.logger import logging
+import serialization
+
+# Binance accepts up to 1024 streams per connection, stay well below it.
+STREAMS_PER_CONNECTION = int(environ.get("STREAMS_PER_CONNECTION", 200))
+# Symbols are spread over at least this many connections.
+STREAM_CONNECTIONS = int(environ.get("STREAM_CONNECTIONS", 4))
+# Seconds before reconnecting a dropped connection, doubled after each failed attempt up to the maximum.
+RECONNECT_DELAY = float(environ.get("RECONNECT_DELAY", 0.5))
+RECONNECT_MAX_DELAY = float(environ.get("RECONNECT_MAX_DELAY", 30))
+
+
+class StreamConnection:
+    """
+        One upstream websocket and the symbols streamed through it.
+
+        Like websocket-client's WebSocketApp, frames are handed to `on_message(connection, message)`. Everything
+        runs on the ingestion event loop. A dropped connection is opened again, and its symbols subscribed again,
+        until it is closed.
+    """
+
+    def __init__(self, api_url: str, on_message: Callable, on_error: Callable,
+                 on_open: Optional[Callable[["StreamConnection"], Awaitable]] = None, pinned: bool = False) -> None:
+        self.api_url = api_url
+        self.on_message = on_message
+        self.on_error = on_error
+        self.on_open = on_open
+        # Pinned connections are never closed by the pool, run() blocks on one of them.
+        self.pinned = pinned
+        self.symbols: Set[str] = set()
+        self.last_id = 0
+        self.websocket = None
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    async def run(self) -> "StreamConnection":
+        """Streams until cancelled, reconnecting with backoff whenever the connection drops."""
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                async with websockets.connect(self.api_url) as websocket:
+                    self.websocket = websocket
+                    await self.handle_open()
+                    delay = RECONNECT_DELAY
+                    async for message in websocket:
+                        try:
+                            self.on_message(self, message)
+                        except Exception as e:
+                            self.on_error(self, e)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.on_error(self, e)
+            finally:
+                self.websocket = None
+
+            logging.warning(f"Stream connection dropped with {len(self)} symbols, reconnecting in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def handle_open(self):
+        # Symbols assigned before the connection was ready, or streamed before it dropped
+        if self.symbols:
+            await self.send("SUBSCRIBE", list(self.symbols))
+        if self.on_open:
+            await self.on_open(self)
+
+    async def send(self, method: str, symbols: List[str]):
+        self.last_id += 1
+        message = serialization.dumps({
+            "method": method,
+            "params": [f"{symbol}@trade" for symbol in symbols],
+            "id": self.last_id,
+        })
+        logging.info(f"[Send]: {message}")
+        await self.websocket.send(message)
+
+    async def subscribe(self, symbols: Iterable[str]):
+        symbols = list(symbols)
+        self.symbols.update(symbols)
+        if symbols and self.websocket is not None:
+            await self.send("SUBSCRIBE", symbols)
+
+    async def unsubscribe(self, symbols: Iterable[str]):
+        symbols = list(symbols)
+        self.symbols.difference_update(symbols)
+        if symbols and self.websocket is not None:
+            await self.send("UNSUBSCRIBE", symbols)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+class StreamPool:
+    """
+        Spreads the streamed symbols over several upstream connections.
+
+        Symbols go to the least loaded connection, new connections are opened until there are `size` of them or
+        when all of them hold `streams_per_connection` symbols. Connections left with nothing to stream are closed.
+        Every connection feeds the same on_message callback.
+    """
+
+    def __init__(self, api_url: str, on_message: Callable, on_error: Callable,
+                 size: int = STREAM_CONNECTIONS, streams_per_connection: int = STREAMS_PER_CONNECTION) -> None:
+        self.api_url = api_url
+        self.on_message = on_message
+        self.on_error = on_error
+        self.size = size
+        self.streams_per_connection = streams_per_connection
+        self.connections: List[StreamConnection] = []
+        self.owners: Dict[str, StreamConnection] = {}
+
+    def symbols(self) -> Set[str]:
+        return set(self.owners)
+
+    def open(self, on_open: Optional[Callable] = None, pinned: bool = False) -> StreamConnection:
+        connection = StreamConnection(self.api_url, self.on_message, self.on_error, on_open=on_open, pinned=pinned)
+        self.connections.append(connection)
+        return connection
+
+    def pick(self) -> StreamConnection:
+        available = [c for c in self.connections if len(c) < self.streams_per_connection]
+        idle = [c for c in available if not len(c)]
+        if idle:
+            return idle[0]
+        if not available or len(self.connections) < self.size:
+            connection = self.open()
+            connection.start()
+            return connection
+        return min(available, key=len)
+
+    async def update(self, symbols: Set[str]):
+        """Streams exactly `symbols`, subscribing and unsubscribing only the difference."""
+        to_unsubscribe = self.symbols() - symbols
+        to_subscribe = symbols - self.symbols()
+
+        removed: Dict[StreamConnection, List[str]] = {}
+        for symbol in to_unsubscribe:
+            removed.setdefault(self.owners.pop(symbol), []).append(symbol)
+        for connection, connection_symbols in removed.items():
+            await connection.unsubscribe(connection_symbols)
+
+        await self.assign(to_subscribe)
+        if to_unsubscribe:
+            await self.rebalance()
+
+    async def assign(self, symbols: Iterable[str]):
+        added: Dict[StreamConnection, List[str]] = {}
+        for symbol in symbols:
+            connection = self.pick()
+            # Count the symbol right away so the next pick sees the new load
+            connection.symbols.add(symbol)
+            added.setdefault(connection, []).append(symbol)
+            self.owners[symbol] = connection
+        for connection, connection_symbols in added.items():
+            await connection.subscribe(connection_symbols)
+
+    async def rebalance(self):
+        """Closes the connections that are no longer needed, moving their symbols to the others."""
+        needed = max(self.size, ceil(len(self.owners) / self.streams_per_connection))
+        for connection in sorted(self.connections, key=len):
+            if len(self.connections) <= needed:
+                break
+            if connection.pinned:
+                continue
+
+            self.connections.remove(connection)
+            symbols = list(connection.symbols)
+            # Subscribe somewhere else before leaving, a symbol is briefly received twice instead of missed
+            await self.assign(symbols)
+            connection.close()
+
+        for connection in list(self.connections):
+            if not len(connection) and not connection.pinned:
+                self.connections.remove(connection)
+                connection.close()
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.owners = {}
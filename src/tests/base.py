@@ -1,18 +1,22 @@
 from os import environ
+import asyncio
 import mock
 import random
 import pytest
 import json
 import contextlib
 from threading import Thread
+from typing import Callable, Set
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy_utils import create_database, database_exists, drop_database
 
 from sql import database
-from websocket import WebSocketApp
+from sql.database import InstrumentedQueuePool
+from streams import StreamConnection
 from ingestion import Ingestion
+from benchmarks.binance_server import BinanceServer
 from logger.logger import logging
 
 
@@ -43,19 +47,42 @@ def db_session(setup_database, connection):
 
 
 @contextlib.contextmanager
-def mock_websocketapp():
-    def mocked_run_forever(self, *args, **kwargs) -> WebSocketApp:
-        self.on_open(self)
+def mock_websocketapp(keep_open: bool = False):
+    """
+        Mocks the upstream connections: they open right away, then either return or stay open until cancelled.
+    """
+    async def mocked_run(self) -> StreamConnection:
+        self.websocket = self
+        await self.handle_open()
+        if keep_open:
+            await asyncio.Event().wait()
         return self
 
-    def mocked_send(self, data, opcode=None):
+    async def mocked_send(self, method, symbols):
         logging.debug("Run mocked send")
 
-    with mock.patch.object(WebSocketApp, 'run_forever', new=mocked_run_forever), \
-         mock.patch.object(WebSocketApp, 'send', new=mocked_send):
+    with mock.patch.object(StreamConnection, 'run', new=mocked_run), \
+         mock.patch.object(StreamConnection, 'send', new=mocked_send):
         yield
 
 
+@contextlib.contextmanager
+def binance_server(**kwargs):
+    """
+        Runs a local Binance stand-in on its own thread and event loop, for the actual upstream connections.
+    """
+    loop = asyncio.new_event_loop()
+    thread = Thread(target=loop.run_forever, name="binance-server", daemon=True)
+    thread.start()
+    server = asyncio.run_coroutine_threadsafe(BinanceServer(**kwargs).start(), loop).result()
+    try:
+        yield server
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+
 def mock_trade_message(symbol: str, value: float):
     return json.dumps({
         "e": "trade",
@@ -76,16 +103,62 @@ def mock_subscription_message(symbol: str, threshold: float):
     return json.dumps({"symbol": symbol.lower(), "threshold": f"{threshold:.8f}"})
 
 
-def run_until(func, timeout):
+def run_until(func, timeout) -> Thread:
     t = Thread(target=func, name="ingestion")
     t.daemon = True
     t.start()
     t.join(timeout=timeout)
+    return t
+
+
+@contextlib.contextmanager
+def serving(ingestion: Ingestion, timeout: float):
+    """
+        Runs the ingestion into a different thread for `timeout` seconds, then lets the test check it while it keeps
+        serving. The upstream connections reconnect until stopped, so the ingestion is stopped on the way out.
+    """
+    thread = run_until(ingestion.run, timeout)
+    try:
+        yield
+    finally:
+        ingestion.stop()
+        thread.join(timeout=5)
+
+
+def run_on_loop(ingestion: Ingestion, func, *args):
+    """Calls func on the event loop of an ingestion running in another thread, and waits for its result."""
+    async def call():
+        return func(*args)
+    return asyncio.run_coroutine_threadsafe(call(), ingestion.loop).result()
 
 
 def mock_get_engine():
     db_credentials = environ.get("TEST_DB_CONN")
-    return create_engine(db_credentials, pool_size=20, max_overflow=0)
+    return create_engine(db_credentials, poolclass=InstrumentedQueuePool, pool_size=20, max_overflow=0)
+
+
+def explain(connection, query: Callable) -> str:
+    """EXPLAIN of the last statement `query` runs on the connection."""
+    statements = []
+    capture = lambda conn, cursor, statement, parameters, *args: statements.append((statement, parameters))
+    event.listen(connection, "before_cursor_execute", capture)
+    try:
+        query()
+    finally:
+        event.remove(connection, "before_cursor_execute", capture)
+
+    statement, parameters = statements[-1]
+    return "\n".join(row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}", parameters))
+
+
+def index_names(connection, index: str) -> Set[str]:
+    """The index and, on a partitioned table, the indexes of its partitions."""
+    partitions = connection.execute(
+        text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+             "WHERE i.inhparent = CAST(:index AS regclass)"),
+        {"index": index},
+    ).scalars().all()
+    return {index, *partitions}
 
 
 TestIngestion = lambda: Ingestion(db_credentials=environ.get("TEST_DB_CONN"))
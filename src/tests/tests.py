@@ -4,25 +4,48 @@ import pytest
 from tests.base import db_session, setup_database, connection
 
 import time
+import asyncio
 import logging
 import random
 import json
+import sys
+import importlib
+import mock
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from enums import Symbol
 from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from prometheus_client import REGISTRY
 
-from main import app, get_engine
+import main
+from main import app
 from sql.models import Connection, Subscription, Notification
+from sql.data import (
+    list_current_sub_symbols, list_current_subscriptions, list_current_subscriptions_from_symbol,
+    list_subscriptions_from_connection, list_subscriptions_changed_since, list_notifications_from_subscription,
+    claim_pending_notifications, heartbeat_subscriptions, worker_application_name, HEARTBEAT_LIMIT,
+    NOTIFICATION_CLAIM_LEASE,
+)
+from mirror import WATERMARK_OVERLAP
+from thresholds import ThresholdIndex
+from streams import StreamPool
+from sharding import ShardCoordinator
+from hub import NotificationHub
+from retention import apply_retention
+from sql.partitions import partition_name
+from ticks import Tick, TickQueue
+from ingestion import Ingestion, VECTORIZE_MIN_TICKS
+from writer import NotificationWriter
+import serialization
+from benchmarks.replay import capture, read_recording, replay
 from tests.base import (
-    mock_websocketapp, mock_trade_message, mock_subscription_message, mock_get_engine,
-    TestIngestion, run_until
+    mock_websocketapp, mock_trade_message, mock_subscription_message, mock_get_engine, binance_server,
+    TestIngestion, run_until, run_on_loop, serving, explain, index_names,
 )
 
 
-app.dependency_overrides[get_engine] = mock_get_engine
-
-
 class TestIngestionFunctionally:
     # What do I need to test
     # - [x] Test if we can monitor the symbols we need to subscribe
@@ -91,10 +114,12 @@ class TestIngestionFunctionally:
             # pricing going down - do not send any notification - from 1100 to 900
             ws.on_message(ws, mock_trade_message(Symbol.BTCUSDT, 1100.00))
             ws.on_message(ws, mock_trade_message(Symbol.BTCUSDT, 900.00))
+            ingestion.notifications.flush()
             assert len(db_session.query(Notification).all()) == 0
 
             # pricing going up - do send a notification - from 900 to 1100
             ws.on_message(ws, mock_trade_message(Symbol.BTCUSDT, 1100.00))
+            ingestion.notifications.flush()
             notifications = db_session.query(Notification).all()
             assert len(notifications) == 1
             assert notifications[0].subscription_id == sub_btc_1000.id
@@ -143,6 +168,7 @@ class TestIngestionFunctionally:
             # pricing going up - do send notifications - from 900 to 1100
             ws.on_message(ws, mock_trade_message(Symbol.ETHUSDT, 900.00))
             ws.on_message(ws, mock_trade_message(Symbol.ETHUSDT, 1100.00))
+            ingestion.notifications.flush()
             notifications = db_session.query(Notification).all()
             assert len(notifications) == 2
             for n in notifications:
@@ -155,13 +181,14 @@ class TestIngestionFunctionally:
             Setup:
             - Test database
             - Mock WebSocketApp client simulating an actual run
+              - running into a different thread, the connection stays open
               - on_open will run as well as the periodic background actions
               - it needs some time to run the background actions in order to replace the symbols to subscribe
 
             Test:
             - Ingestion should be able to add and remove into symbol_subs the symbols from the database subscriptions.
         """
-        with mock_websocketapp():
+        with mock_websocketapp(keep_open=True):
             conn = Connection(
                 subscriptions=[
                     Subscription(symbol=Symbol.BTCUSDT, price_threshold="1000")
@@ -173,16 +200,94 @@ class TestIngestionFunctionally:
             assert len(db_session.query(Connection).all()) == 1
 
             ingestion = TestIngestion()
-            ingestion.run()
-            time.sleep(1)
-            assert ingestion.symbol_subs == {Symbol.BTCUSDT}
+            with serving(ingestion, 1):
+                assert ingestion.symbol_subs == {Symbol.BTCUSDT}
 
-            conn.subscriptions[0].finished_at = datetime.utcnow()
+                conn.subscriptions[0].finished_at = datetime.utcnow()
+                db_session.add(conn)
+                db_session.commit()
+
+                time.sleep(1)
+                assert ingestion.symbol_subs == set()
+
+    def test_ingestion_reconciles_on_subscription_notify(self, db_session):
+        """
+            Test if ingestion streams a new symbol as soon as its subscription is created
+
+            Setup:
+            - Test database
+            - Mock WebSocketApp client simulating an actual run, the connection stays open
+            - Periodic reconciliation out of reach, only the NOTIFY of the subscriptions can trigger it
+
+            Test:
+            - A subscription created or finished on the database is streamed or dropped right away
+        """
+        with mock_websocketapp(keep_open=True), mock.patch("ingestion.SUBSCRIPTION_RECONCILE_INTERVAL", 60):
+            conn = Connection()
             db_session.add(conn)
             db_session.commit()
 
-            time.sleep(1)
-            assert ingestion.symbol_subs == set()
+            ingestion = TestIngestion()
+            with serving(ingestion, 0.5):
+                assert ingestion.symbol_subs == set()
+
+                conn.subscriptions.append(Subscription(symbol=Symbol.BTCUSDT, price_threshold="1000"))
+                db_session.commit()
+                time.sleep(0.3)
+                assert ingestion.symbol_subs == {Symbol.BTCUSDT}
+
+                conn.subscriptions[0].finished_at = datetime.utcnow()
+                db_session.commit()
+                time.sleep(0.3)
+                assert ingestion.symbol_subs == set()
+
+    def test_ingestion_mirror_applies_subscription_changes(self, db_session):
+        """
+            Test if the ingestion mirror of the subscriptions follows the changes on the database
+
+            Setup:
+            - Test database
+
+            Test:
+            - The first refresh loads the live subscriptions only
+            - The following refreshes apply new and finished subscriptions
+            - Heartbeats are not read back, a refresh after them fetches nothing
+            - Subscriptions whose heartbeat expires are dropped by the next refresh
+        """
+        sub_btc = Subscription(symbol=Symbol.BTCUSDT, price_threshold="1000")
+        sub_old = Subscription(symbol=Symbol.LTCBTC, price_threshold="1",
+                               last_heartbeat=datetime.utcnow() - timedelta(hours=1))
+        conn = Connection(subscriptions=[sub_btc, sub_old])
+        db_session.add(conn)
+        db_session.commit()
+
+        mirror = TestIngestion().subscriptions
+        mirror.refresh()
+        assert mirror.symbols() == {Symbol.BTCUSDT}
+
+        sub_eth = Subscription(symbol=Symbol.ETHUSDT, price_threshold="2000")
+        conn.subscriptions.append(sub_eth)
+        sub_btc.finished_at = datetime.utcnow()
+        db_session.add(conn)
+        db_session.commit()
+
+        mirror.refresh()
+        assert mirror.symbols() == {Symbol.ETHUSDT}
+        assert mirror.crossed(Symbol.ETHUSDT, 1900, 2100) == [sub_eth.id]
+
+        # Leaves the changes above out of the overlap of the watermark
+        mirror.watermark += timedelta(seconds=WATERMARK_OVERLAP)
+        heartbeat_subscriptions(db_session, [sub_eth.id])
+        db_session.commit()
+        changes = mirror.fetch()
+        assert not changes.full and changes.subs == []
+        mirror.update(changes)
+
+        # The last heartbeat of ETHUSDT, just old enough to expire
+        sub_eth.last_heartbeat = datetime.utcnow() - timedelta(seconds=HEARTBEAT_LIMIT + 1)
+        db_session.commit()
+        mirror.refresh()
+        assert len(mirror) == 0
 
     def test_ingestion_can_subscribe_to_symbol(self, db_session):
         """
@@ -212,29 +317,1015 @@ class TestIngestionFunctionally:
 
         # run ingestion for 4 seconds with a BTCUSDT subscription
         ingestion = TestIngestion()
-        run_until(ingestion.run, 4)
+        with serving(ingestion, 4):
+            # Should have gotten at least one price.
+            assert set(ingestion.previous_prices.keys()) == {Symbol.BTCUSDT}
 
-        # Should have gotten at least one price.
-        assert set(ingestion.previous_prices.keys()) == {Symbol.BTCUSDT}
+            # Turn off BTCUSDT subscription and turn on ETHUSDT
+            conn.subscriptions[0].finished_at = datetime.utcnow()
+            conn.subscriptions.append(Subscription(symbol=Symbol.ETHUSDT, price_threshold="2000"))
+            db_session.add(conn)
+            db_session.commit()
+
+            # Ingestion keeps running on its thread, wait a bit more to clean BTCUSDT messages out.
+            time.sleep(1)
+            # Cleaning up the prices but keeping the subscriptions
+            ingestion.previous_prices = {}
+
+            # let ingestion run for 4 seconds with a ETHUSDT subscription
+            time.sleep(4)
+
+            # Should have only ETHUSDT subscribed
+            assert ingestion.symbol_subs == {Symbol.ETHUSDT}
+            # Now, since only ETHUSDT is subscribed, only prices from ETHUSDT is there.
+            assert set(ingestion.previous_prices.keys()) == {Symbol.ETHUSDT}
 
-        # Turn off BTCUSDT subscription and turn on ETHUSDT
-        conn.subscriptions[0].finished_at = datetime.utcnow()
-        conn.subscriptions.append(Subscription(symbol=Symbol.ETHUSDT, price_threshold="2000"))
+
+class TestBinanceServer:
+
+    def test_ingestion_streams_from_local_binance_server(self, db_session):
+        """
+            Test if ingestion subscribes, receives trades and notifies through an actual websocket connection
+
+            Setup:
+            - Test database
+            - Local Binance stand-in, BTCUSDT rising by 1 on every frame from 1000, 100 frames per second
+            - Actual upstream connections to it, running into a different thread
+
+            Test:
+            - Ingestion should subscribe to BTCUSDT with a SUBSCRIBE request
+            - The rising trades should cross the 1010.5 threshold once and write a notification
+            - Finishing the subscription should send an UNSUBSCRIBE request
+        """
+        conn = Connection(
+            subscriptions=[
+                Subscription(symbol=Symbol.BTCUSDT, price_threshold="1010.5")
+            ]
+        )
+        db_session.add(conn)
+        db_session.commit()
+
+        with binance_server(rate=100, process="ramp", price=1000, volatility=0.001) as server:
+            ingestion = Ingestion(api_url=server.url)
+            with serving(ingestion, 1):
+                assert {"method": "SUBSCRIBE", "params": ["btcusdt@trade"], "id": 1} in server.requests
+                assert ingestion.symbol_subs == {Symbol.BTCUSDT}
+
+                notifications = db_session.query(Notification).all()
+                assert len(notifications) == 1
+                assert notifications[0].subscription_id == conn.subscriptions[0].id
+                assert notifications[0].message == "Price has surpassed the threshold: 1011.0"
+
+                conn.subscriptions[0].finished_at = datetime.utcnow()
+                db_session.add(conn)
+                db_session.commit()
+
+                time.sleep(1)
+                assert ingestion.symbol_subs == set()
+                assert server.requests[-1]["method"] == "UNSUBSCRIBE"
+
+    def test_ingestion_coalesces_a_burst_without_missing_crossings(self, db_session):
+        """
+            Test if a burst of trades gets coalesced by the running ingestion, every threshold still notified once
+
+            Setup:
+            - Test database, thresholds every 5 from 1005.05 to 1050.05
+            - Local Binance stand-in, BTCUSDT rising by 0.1 on every frame from 1000, 10000 frames per second
+            - Ingestion without the NumPy evaluation, with the default tick queue
+
+            Test:
+            - Trades are coalesced between the rounds of the evaluation task
+            - Every threshold crossed by the burst is notified exactly once
+        """
+        thresholds = range(1005, 1051, 5)
+        conn = Connection(
+            subscriptions=[Subscription(symbol=Symbol.BTCUSDT, price_threshold=t + 0.05) for t in thresholds]
+        )
+        db_session.add(conn)
+        db_session.commit()
+
+        coalesced = REGISTRY.get_sample_value("ingestion_ticks_coalesced_total") or 0
+        with binance_server(rate=10000, process="ramp", price=1000, volatility=0.0001) as server, \
+                mock.patch("ingestion.VECTORIZE_MIN_TICKS", 0):
+            ingestion = Ingestion(api_url=server.url)
+            with serving(ingestion, 1):
+                assert REGISTRY.get_sample_value("ingestion_ticks_coalesced_total") > coalesced
+                run_on_loop(ingestion, ingestion.flush)
+                notified = sorted(n.subscription_id for n in db_session.query(Notification).all())
+                assert notified == sorted(sub.id for sub in conn.subscriptions)
+
+    def test_ingestion_vectorizes_the_runs_past_its_bound(self, db_session):
+        """
+            Test if the trades of a symbol received faster than the evaluation task runs are evaluated with NumPy
+
+            Setup:
+            - Test database, thresholds every 5 from 1005.05 to 1050.05
+            - Mock WebSocketApp client, the connection stays open
+            - A burst of 1000 BTCUSDT frames rising by 0.1 from 1000, received without the evaluation task running
+
+            Test:
+            - Runs of VECTORIZE_MIN_TICKS trades are handed to the vectorized crossings, nothing is coalesced
+            - Every threshold crossed by the burst is notified exactly once
+        """
+        thresholds = range(1005, 1051, 5)
+        conn = Connection(
+            subscriptions=[Subscription(symbol=Symbol.BTCUSDT, price_threshold=t + 0.05) for t in thresholds]
+        )
         db_session.add(conn)
         db_session.commit()
 
-        # Run a bit more with to clean BTCUSDT messages out.
-        run_until(ingestion.run, 1)
-        # Cleaning up the prices but keeping the subscriptions
-        ingestion.previous_prices = {}
+        def burst():
+            connection = ingestion.streams.connections[0]
+            for i in range(1000):
+                ingestion.on_message(connection, mock_trade_message(Symbol.BTCUSDT, 1000 + i / 10))
+            ingestion.flush()
+
+        coalesced = REGISTRY.get_sample_value("ingestion_ticks_coalesced_total") or 0
+        with mock_websocketapp(keep_open=True):
+            ingestion = TestIngestion()
+            with serving(ingestion, 1), \
+                    mock.patch.object(ingestion.subscriptions, "crossings",
+                                      wraps=ingestion.subscriptions.crossings) as crossings:
+                run_on_loop(ingestion, burst)
+
+        assert crossings.call_count >= 1000 // (VECTORIZE_MIN_TICKS + 1)
+        assert all(len(call.args[2]) >= VECTORIZE_MIN_TICKS for call in crossings.call_args_list)
+        assert (REGISTRY.get_sample_value("ingestion_ticks_coalesced_total") or 0) == coalesced
+        notified = sorted(n.subscription_id for n in db_session.query(Notification).all())
+        assert notified == sorted(sub.id for sub in conn.subscriptions)
+
+    def test_ingestion_resubscribes_after_a_disconnect(self, db_session):
+        """
+            Test if ingestion reconnects every dropped upstream connection and streams its symbols again
+
+            Setup:
+            - Test database
+            - Local Binance stand-in streaming 3 symbols, one upstream connection each, the pinned one included
+            - Actual upstream connections to it, running into a different thread
+
+            Test:
+            - Once the server drops every client, each symbol is subscribed again with a new SUBSCRIBE request
+            - Trades of every symbol are received again
+        """
+        symbols = {Symbol.BTCUSDT, Symbol.ETHUSDT, Symbol.BNBBTC}
+        conn = Connection(
+            subscriptions=[Subscription(symbol=symbol, price_threshold="1000000") for symbol in symbols]
+        )
+        db_session.add(conn)
+        db_session.commit()
+
+        def subscribed():
+            return [
+                param[:-len("@trade")]
+                for request in server.requests if request["method"] == "SUBSCRIBE"
+                for param in request["params"]
+            ]
+
+        with binance_server(rate=50) as server:
+            ingestion = Ingestion(api_url=server.url)
+            with serving(ingestion, 1):
+                assert server.subscriptions() == symbols
+                assert sorted(subscribed()) == sorted(symbols)
+                assert len(ingestion.streams.connections) == 3
+
+                asyncio.run_coroutine_threadsafe(server.disconnect(), server.loop).result()
+                ingestion.previous_prices.clear()
+                time.sleep(1.5)
+
+                assert sorted(subscribed()) == sorted(list(symbols) * 2)
+                assert server.subscriptions() == symbols
+                assert set(ingestion.previous_prices) == symbols
+
+    def test_ingestion_reconciles_one_round_at_a_time_across_reconnects(self, db_session):
+        """
+            Test if reconnecting the pinned upstream connection never overlaps two reconciliations
+
+            Setup:
+            - Test database
+            - Local Binance stand-in streaming one symbol through the pinned connection
+            - Ingestion reconciling every 50 ms, each round taking 200 ms
+
+            Test:
+            - While the server drops the client three times, reconciliation rounds never run concurrently
+            - The symbol is streamed again once reconnected
+        """
+        conn = Connection(subscriptions=[Subscription(symbol=Symbol.BTCUSDT, price_threshold="1000000")])
+        db_session.add(conn)
+        db_session.commit()
+
+        rounds = {"running": 0, "concurrent": 0}
+        with binance_server(rate=50) as server, mock.patch("ingestion.SUBSCRIPTION_RECONCILE_INTERVAL", 0.05):
+            ingestion = Ingestion(api_url=server.url)
+            check_current_subs = ingestion.check_current_subs
+
+            async def slow_check_current_subs():
+                rounds["running"] += 1
+                rounds["concurrent"] = max(rounds["concurrent"], rounds["running"])
+                try:
+                    await asyncio.sleep(0.2)
+                    await check_current_subs()
+                finally:
+                    rounds["running"] -= 1
+
+            ingestion.check_current_subs = slow_check_current_subs
+            with serving(ingestion, 1):
+                for _ in range(3):
+                    asyncio.run_coroutine_threadsafe(server.disconnect(), server.loop).result()
+                    time.sleep(0.3)
+                time.sleep(1)
+
+                assert rounds["concurrent"] == 1
+                assert server.subscriptions() == {Symbol.BTCUSDT}
+                assert ingestion.symbol_subs == {Symbol.BTCUSDT}
+
+
+class TestReplay:
+
+    def test_replay_feeds_a_captured_recording_through_the_ingestion(self, db_session, tmp_path):
+        """
+            Test if a recording captured from a Binance endpoint is replayed through the ingestion
+
+            Setup:
+            - Test database
+            - Recording of BTCUSDT trades captured from the local Binance stand-in, rising by 1 on every frame
+            - Thresholds every 10 over the recorded prices
+
+            Test:
+            - Every trade captured is read back, and only the trades
+            - Replaying it notifies every threshold exactly once
+        """
+        path = str(tmp_path / "trades.jsonl.gz")
+        with binance_server(rate=200, process="ramp", price=1000, volatility=0.001) as server:
+            count = asyncio.run(capture(server.url, [Symbol.BTCUSDT], path, 0.5))
+
+        frames, ranges = read_recording(path)
+        assert len(frames) == count > 10
+        assert list(ranges) == [Symbol.BTCUSDT]
+        low, high = ranges[Symbol.BTCUSDT]
+
+        subs = [
+            Subscription(symbol=Symbol.BTCUSDT, price_threshold=threshold + 0.5)
+            for threshold in range(int(low), int(high), 10)
+        ]
+        db_session.add(Connection(subscriptions=subs))
+        db_session.commit()
+
+        ingestion = Ingestion(sharding=False)
+        ingestion.subscriptions.refresh()
+        asyncio.run(replay(ingestion, frames, None, burst=8))
+        ingestion.flush()
+        ingestion.executor.shutdown(wait=True)
+        ingestion.engine.dispose()
+
+        notified = sorted(n.subscription_id for n in db_session.query(Notification).all())
+        assert notified == sorted(sub.id for sub in subs)
+
+
+class TestShardCoordinator:
+
+    def test_shard_coordinators_split_symbols_and_fail_over(self, db_session):
+        """
+            Test if ingestion workers split the symbols among themselves and take over the symbols of a finished one
+
+            Setup:
+            - Test database
+            - Two coordinators, as two ingestion processes would have
+
+            Test:
+            - Each symbol is claimed by exactly one worker
+            - Once a worker is gone, the other one claims every symbol
+        """
+        engine = mock_get_engine()
+        symbols = {Symbol.BTCUSDT, Symbol.ETHUSDT, Symbol.ETHBTC, Symbol.LTCBTC, Symbol.BNBBTC, Symbol.NEOBTC}
+        first, second = ShardCoordinator(engine), ShardCoordinator(engine)
+        first.claim(symbols)
+        second.claim(symbols)
+        # Both workers see each other now
+        first.workers_at = second.workers_at = 0
+
+        first_symbols = first.claim(symbols)
+        first.release()
+        second_symbols = second.claim(symbols)
+        assert first_symbols | second_symbols == symbols
+        assert not first_symbols & second_symbols
+
+        first.close()
+        second.workers_at = 0
+        assert second.claim(symbols) == symbols
+        second.close()
+        engine.dispose()
+
+
+    def test_shard_coordinators_reap_an_expired_worker(self, db_session):
+        """
+            Test if a worker that stops heartbeating loses its symbols to the others once its lease expires
+
+            Setup:
+            - Test database, WORKER_LEASE of 1 second
+            - Two coordinators splitting the symbols, the first one stalls: it doesn't claim, so doesn't heartbeat
+
+            Test:
+            - Once the lease expired, the other worker reaps it and claims every symbol
+            - The lock connection of the reaped worker is terminated, its locks with it
+            - The reaped worker finds out on its next claim and gives up its symbols
+        """
+        engine = mock_get_engine()
+        symbols = {Symbol.BTCUSDT, Symbol.ETHUSDT, Symbol.ETHBTC, Symbol.LTCBTC, Symbol.BNBBTC, Symbol.NEOBTC}
+        with mock.patch("sql.data.WORKER_LEASE", 1), mock.patch("sharding.WORKER_LEASE", 1):
+            first, second = ShardCoordinator(engine), ShardCoordinator(engine)
+            first.claim(symbols)
+            second.claim(symbols)
+            first.workers_at = second.workers_at = 0
+            first_symbols = first.claim(symbols)
+            first.release()
+            second_symbols = second.claim(symbols)
+            assert first_symbols and second_symbols
+            assert first_symbols | second_symbols == symbols
+
+            time.sleep(1.5)
+            # The locks go away with the terminated backend, a moment after the reap
+            for _ in range(20):
+                second.workers_at = 0
+                if second.claim(symbols) == symbols:
+                    break
+                time.sleep(0.1)
+            assert second.claim(symbols) == symbols
+            assert second.workers == [second.worker_id]
+
+            with engine.connect() as connection:
+                stalled = connection.execute(
+                    text("SELECT count(*) FROM pg_stat_activity WHERE application_name = :name"),
+                    {"name": worker_application_name(first.worker_id)},
+                ).scalar()
+            assert stalled == 0
+            assert first.claim(symbols) == set()
+            assert first.worker_id is None
+
+            second.close()
+            first.close()
+        engine.dispose()
+
+
+class TestDataQueries:
+
+    def test_hot_queries_use_their_indexes(self, db_session, connection):
+        """
+            Test if the queries run at every tick are served by an index instead of scanning the tables
+
+            Setup:
+            - Test database with a history: finished connections, subscriptions and delivered notifications, and a
+              few live subscriptions, analyzed
+            - The statements run by the query functions of sql.data
+
+            Test:
+            - EXPLAIN of each statement uses the index matching its filters
+        """
+        symbols = [Symbol.BTCUSDT, Symbol.ETHUSDT, Symbol.ETHBTC, Symbol.LTCBTC, Symbol.BNBBTC, Symbol.NEOBTC]
+        db_session.execute(text("""
+            INSERT INTO connections (created_at, finished_at)
+            SELECT timezone('utc', now()) - interval '1 day', timezone('utc', now()) - interval '1 hour'
+            FROM generate_series(1, 2000)
+        """))
+        db_session.execute(text("""
+            INSERT INTO subscriptions (connection_id, symbol, price_threshold, created_at, last_heartbeat, finished_at)
+            SELECT id, (:symbols)[1 + id % 6], 1000, created_at, finished_at, finished_at FROM connections
+        """), {"symbols": symbols})
+        db_session.execute(text("""
+            INSERT INTO notifications (subscription_id, symbol, message, order_ref, created_at, finished_at)
+            SELECT id, symbol, 'Delivered', n, finished_at, finished_at FROM subscriptions, generate_series(1, 5) n
+        """))
+        db_session.commit()
+        for symbol in symbols * 20:
+            conn = Connection()
+            db_session.add(conn)
+            db_session.commit()
+            sub = Subscription(symbol=symbol, connection_id=conn.id, price_threshold=1000)
+            db_session.add(sub)
+            db_session.commit()
+
+        # Indexes each plan has to use, any of them when more than one fits
+        current = ("ix_subscriptions_live_symbol", "ix_subscriptions_live_connection", "ix_subscriptions_last_heartbeat")
+        expected = [
+            (lambda: list_current_sub_symbols(db_session), [current]),
+            (lambda: list_current_subscriptions(db_session), [current]),
+            (lambda: list_current_subscriptions_from_symbol(db_session, Symbol.BTCUSDT),
+             [("ix_subscriptions_live_symbol",)]),
+            (lambda: list_subscriptions_from_connection(db_session, conn.id), [("ix_subscriptions_live_connection",)]),
+            (lambda: list_subscriptions_changed_since(db_session, datetime.utcnow(), datetime.utcnow()),
+             [("ix_subscriptions_updated_at",), ("ix_subscriptions_last_heartbeat",)]),
+            (lambda: list_notifications_from_subscription(db_session, sub.id), [("ix_notifications_pending",)]),
+            (lambda: claim_pending_notifications(db_session, [sub.id]), [("ix_notifications_pending",)]),
+        ]
+
+        connection.exec_driver_sql("ANALYZE")
+        for query, requirements in expected:
+            plan = explain(connection, query)
+            for indexes in requirements:
+                assert any(name in plan for index in indexes for name in index_names(connection, index)), plan
+
+    def test_retention_drops_old_partitions_and_queries_prune_them(self, db_session, connection):
+        """
+            Test if the retention job keeps the notifications partitions of the retention and nothing older
+
+            Setup:
+            - Test database, with daily notifications partitions of the last 10 days
+            - A notification 9 days old and a new one, pending
+
+            Test:
+            - Partitions past the retention are dropped whole, with their rows, and the new ones are created ahead
+            - The claim of the pending notifications skips the partitions older than the delivery window
+        """
+        today = datetime.utcnow().date()
+        engine = mock_get_engine()
+        created, dropped = apply_retention(engine, today=today - timedelta(days=10), retention_days=30, ahead=13)
+        assert len(created) == 13 and not dropped
+
+        conn = Connection()
+        db_session.add(conn)
+        db_session.commit()
+        sub = Subscription(symbol=Symbol.BTCUSDT, connection_id=conn.id, price_threshold=1000)
+        db_session.add(sub)
+        db_session.commit()
+        old, new = (
+            Notification(subscription_id=sub.id, symbol=sub.symbol, message="Old", order_ref=1,
+                         created_at=datetime.utcnow() - timedelta(days=9)),
+            Notification(subscription_id=sub.id, symbol=sub.symbol, message="New", order_ref=2),
+        )
+        db_session.add_all([old, new])
+        db_session.commit()
+
+        created, dropped = apply_retention(engine, today=today, retention_days=3, ahead=4)
+        assert created == [partition_name(today + timedelta(days=3))]
+        assert dropped == [partition_name(today - timedelta(days=days)) for days in range(10, 2, -1)]
+        db_session.expire_all()
+        assert [notification.message for notification in db_session.query(Notification).all()] == ["New"]
+        engine.dispose()
+
+        # Last, EXPLAIN leaves its transaction open on the connection
+        plan = explain(connection, lambda: claim_pending_notifications(db_session, [sub.id]))
+        assert partition_name(today) in plan
+        assert partition_name(today - timedelta(days=2)) not in plan
+
+    def test_retention_moves_the_rows_caught_by_the_default_partition(self, db_session):
+        """
+            Test if the retention job creates the partitions of the days the default partition already holds rows of
+
+            Setup:
+            - Test database created without daily partitions, as by Ingestion.setup_database
+            - A notification of today and one 9 days old, both caught by the default partition
+            - A table already named after the partition of tomorrow, so that creating it fails
+
+            Test:
+            - The partition of today is created and today's notification moved to it, the new rows land there too
+            - The partition of tomorrow is skipped, the others are created and the old rows deleted anyway
+        """
+        today = datetime.utcnow().date()
+        conn = Connection()
+        db_session.add(conn)
+        db_session.commit()
+        sub = Subscription(symbol=Symbol.BTCUSDT, connection_id=conn.id, price_threshold=1000)
+        db_session.add(sub)
+        db_session.commit()
+        old, new = (
+            Notification(subscription_id=sub.id, symbol=sub.symbol, message="Old", order_ref=1,
+                         created_at=datetime.utcnow() - timedelta(days=9)),
+            Notification(subscription_id=sub.id, symbol=sub.symbol, message="New", order_ref=2),
+        )
+        db_session.add_all([old, new])
+        db_session.execute(text(f"CREATE TABLE {partition_name(today + timedelta(days=1))} (id bigint)"))
+        db_session.commit()
+
+        engine = mock_get_engine()
+        created, dropped = apply_retention(engine, today=today, retention_days=3, ahead=3)
+        engine.dispose()
+        assert created == [partition_name(today), partition_name(today + timedelta(days=2))]
+        assert dropped == []
+
+        db_session.add(Notification(subscription_id=sub.id, symbol=sub.symbol, message="Newer", order_ref=3))
+        db_session.commit()
+        rows = db_session.execute(text("SELECT message, tableoid::regclass::text FROM notifications")).all()
+        assert sorted(rows) == [("New", partition_name(today)), ("Newer", partition_name(today))]
+
+
+class TestThresholdIndex:
+
+    def test_threshold_index_finds_crossed_thresholds(self):
+        """
+            Test if the threshold index only returns the thresholds strictly inside a rising price move
+
+            Test:
+            - Thresholds on the boundaries, below, above or from other symbols are not returned
+            - Price going down returns nothing
+            - Removed subscriptions are not returned anymore
+        """
+        index = ThresholdIndex()
+        index.add("sub_900", Symbol.BTCUSDT, 900)
+        index.add("sub_1000", Symbol.BTCUSDT, 1000)
+        index.add("sub_1000_b", Symbol.BTCUSDT, 1000)
+        index.add("sub_1100", Symbol.BTCUSDT, 1100)
+        index.add("sub_eth_1000", Symbol.ETHUSDT, 1000)
+
+        assert sorted(index.crossed(Symbol.BTCUSDT, 900, 1100)) == ["sub_1000", "sub_1000_b"]
+        assert index.crossed(Symbol.BTCUSDT, 1100, 900) == []
+
+        index.remove("sub_1000_b")
+        assert index.crossed(Symbol.BTCUSDT, 950, 1050) == ["sub_1000"]
+
+        index.remove("sub_eth_1000")
+        assert index.symbols() == {Symbol.BTCUSDT}
+
+    def test_threshold_index_crossings_match_the_scalar_path(self):
+        """
+            Test if the vectorized crossings of a run of prices are the ones `crossed` finds price after price
+
+            Test:
+            - Same crossings, in the same order, for random runs with and without previous price
+            - Thresholds added or removed after a first evaluation are taken into account
+        """
+        rng = random.Random(7)
+        index = ThresholdIndex()
+        for i in range(300):
+            index.add(f"sub_{i}", Symbol.BTCUSDT, rng.choice(range(900, 1100, 5)))
+
+        def scalar(previous_price, prices):
+            crossings = []
+            for i, price in enumerate(prices):
+                if previous_price and previous_price < price:
+                    sub_ids = index.crossed(Symbol.BTCUSDT, previous_price, price)
+                    if sub_ids:
+                        crossings.append((i, sub_ids))
+                previous_price = price
+            return crossings
 
-        # run ingestion for 4 seconds with a ETHUSDT subscription
-        run_until(ingestion.run, 4)
+        for previous_price in [None, 1000.0, 1000.0]:
+            prices = [rng.choice(range(880, 1120, 5)) + rng.random() * rng.choice([0, 1]) for _ in range(200)]
+            assert index.crossings(Symbol.BTCUSDT, previous_price, prices) == scalar(previous_price, prices)
+            index.remove(f"sub_{rng.randrange(300)}")
+            index.add(f"sub_new_{previous_price}", Symbol.BTCUSDT, 1000)
 
-        # Should have only ETHUSDT subscribed
-        assert ingestion.symbol_subs == {Symbol.ETHUSDT}
-        # Now, since only ETHUSDT is subscribed, only prices from ETHUSDT is there.
-        assert set(ingestion.previous_prices.keys()) == {Symbol.ETHUSDT}
+        assert index.crossings(Symbol.ETHUSDT, 900, [1000, 1100]) == []
+
+
+class TestTickQueue:
+
+    def test_tick_queue_coalesces_without_missing_crossings(self):
+        """
+            Test if the tick queue coalesces the trades of a symbol once full, keeping every crossing
+
+            Test:
+            - Once full, the queue keeps at most first/low/high/last for the symbol
+            - Every threshold crossed upwards by the original trades is still crossed by the coalesced ones
+            - The last price is kept
+        """
+        prices = [1000, 1100, 950, 1050, 900, 1200, 1150, 1000, 1020]
+        queue = TickQueue(size=4)
+        for i, price in enumerate(prices):
+            queue.put(Symbol.BTCUSDT, Tick(price, i, 0.0))
+
+        assert len(queue) <= 4
+        [(symbol, ticks)] = queue.drain()
+        coalesced = [tick.price for tick in ticks]
+        assert symbol == Symbol.BTCUSDT
+        assert coalesced[-1] == prices[-1]
+
+        def crossed(sequence):
+            thresholds = range(900, 1200, 5)
+            return {t for a, b in zip(sequence, sequence[1:]) for t in thresholds if a < t < b}
+        assert crossed(prices) <= crossed(coalesced)
+        assert len(queue) == 0
+
+
+class TestNotificationWriter:
+
+    def test_notification_writer_retries_failed_batches_off_the_loop(self, db_session):
+        """
+            Test if the notification writer never writes from put and retries the batches it failed to write
+
+            Setup:
+            - The first transaction of the writer fails, as if the database was down
+
+            Test:
+            - A buffer filled up to its bound wakes the writer task, put doesn't write itself
+            - The failed batch is written by the next attempt, none of its notifications is lost
+        """
+        sub = Subscription(symbol=Symbol.BTCUSDT, price_threshold=1000)
+        db_session.add(Connection(subscriptions=[sub]))
+        db_session.commit()
+        rows = [
+            {"subscription_id": sub.id, "symbol": Symbol.BTCUSDT, "message": "up", "order_ref": i}
+            for i in range(5)
+        ]
+
+        engine = mock_get_engine()
+        begin = engine.begin
+        attempts = []
+        def failing_begin():
+            attempts.append(time.time())
+            if len(attempts) == 1:
+                raise RuntimeError("database is down")
+            return begin()
+
+        async def write_notifications():
+            writer = NotificationWriter(engine, batch_size=10, flush_interval=0.01, buffer_size=5)
+            task = asyncio.create_task(writer.run(None))
+            await asyncio.sleep(0)
+            with mock.patch.object(writer, "write", wraps=writer.write) as write:
+                writer.put(rows)
+                assert not write.called
+                while writer.buffer or len(attempts) < 2:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.05)
+            task.cancel()
+            return write.call_count
+
+        with mock.patch.object(engine, "begin", side_effect=failing_begin):
+            assert asyncio.run(write_notifications()) == 2
+
+        db_session.expire_all()
+        assert sorted(n.order_ref for n in db_session.query(Notification).all()) == list(range(5))
+
+    def test_notification_writer_drops_what_exceeds_its_buffer(self, caplog):
+        """
+            Test if the notification writer keeps its buffer bounded while the database can't keep up
+
+            Setup:
+            - A writer with a buffer of 10 rows, its writer task not running
+
+            Test:
+            - Notifications past the bound are dropped and counted, the buffered ones are kept in order
+            - The saturation is logged once, and its end once the buffer is back to half of its size
+        """
+        rows = [{"order_ref": i} for i in range(25)]
+        dropped = REGISTRY.get_sample_value("notifications_dropped_total") or 0
+
+        writer = NotificationWriter(None, batch_size=4, buffer_size=10)
+        with caplog.at_level(logging.WARNING):
+            for row in rows:
+                writer.put([row])
+            assert [row["order_ref"] for row in writer.buffer] == list(range(10))
+            assert REGISTRY.get_sample_value("notifications_dropped_total") == dropped + 15
+            assert caplog.text.count("Notification buffer is full") == 1
+
+            writer.take()
+            assert "room again" not in caplog.text
+            writer.take()
+            assert caplog.text.count("Notification buffer has room again, 15 notifications were dropped") == 1
+
+            writer.put(rows[:10])
+            assert len(writer) == 10
+            assert caplog.text.count("Notification buffer is full") == 2
+
+    def test_notification_writer_logs_datetimes_without_orjson(self, db_session, caplog):
+        """
+            Test if the debug log of a written batch works with the standard library json as well
+
+            Setup:
+            - serialization without orjson, as when it is not installed
+            - Debug logs enabled
+
+            Test:
+            - The batch, with its datetimes, is written and logged
+            - The write is reported as successful, not as a failure
+        """
+        sub = Subscription(symbol=Symbol.BTCUSDT, price_threshold=1000)
+        db_session.add(Connection(subscriptions=[sub]))
+        db_session.commit()
+        row = {"subscription_id": sub.id, "symbol": Symbol.BTCUSDT, "message": "up", "order_ref": 1,
+               "detected_at": datetime.utcnow()}
+
+        engine = mock_get_engine()
+        try:
+            with mock.patch.dict(sys.modules, {"orjson": None}), caplog.at_level(logging.DEBUG):
+                importlib.reload(serialization)
+                assert serialization.orjson is None
+                assert NotificationWriter(engine).write([row])
+        finally:
+            importlib.reload(serialization)
+            engine.dispose()
+
+        assert "notifications: [{" in caplog.text
+        assert "Could not write" not in caplog.text
+        assert len(db_session.query(Notification).all()) == 1
+
+
+class TestStreamPool:
+
+    def test_stream_pool_spreads_symbols_over_connections(self):
+        """
+            Test if the stream pool respects the streams per connection and closes the connections not needed anymore
+
+            Setup:
+            - Mock WebSocketApp client, connections open right away
+
+            Test:
+            - Symbols are spread over the minimum amount of connections, none of them above the cap
+            - Removing symbols closes the connections left without streams
+        """
+        async def update_pool():
+            pool = StreamPool("ws://binance", on_message=None, on_error=None, size=2, streams_per_connection=2)
+            symbols = {Symbol.BTCUSDT, Symbol.ETHUSDT, Symbol.ETHBTC, Symbol.LTCBTC, Symbol.BNBBTC}
+
+            await pool.update(symbols)
+            assert pool.symbols() == symbols
+            assert len(pool.connections) == 3
+            assert all(len(connection) <= 2 for connection in pool.connections)
+
+            await pool.update({Symbol.BTCUSDT})
+            assert pool.symbols() == {Symbol.BTCUSDT}
+            assert len(pool.connections) == 1
+            assert pool.owners[Symbol.BTCUSDT].symbols == {Symbol.BTCUSDT}
+            pool.close()
+
+        with mock_websocketapp():
+            asyncio.run(update_pool())
+
+
+class TestNotificationHub:
+
+    def test_notification_hub_routes_every_connection_with_one_query(self, db_session):
+        """
+            Test if the notification hub claims the notifications of all its connections at once
+
+            Setup:
+            - Test database
+            - Three connections with a subscription each, registered into one hub
+
+            Test:
+            - A single UPDATE ... RETURNING leases the notifications and routes each one to the queue of its
+              connection
+            - Claimed notifications are not claimed again
+            - The next dispatch finishes the acked notifications with one UPDATE, and makes a released one pending
+              again before claiming it
+        """
+        subs = []
+        for symbol in (Symbol.BTCUSDT, Symbol.ETHUSDT, Symbol.ETHBTC):
+            conn = Connection()
+            db_session.add(conn)
+            db_session.commit()
+            sub = Subscription(symbol=symbol, connection_id=conn.id, price_threshold=1000)
+            db_session.add(sub)
+            db_session.commit()
+            subs.append(sub)
+        db_session.add_all([
+            Notification(subscription_id=sub.id, symbol=sub.symbol, message=sub.symbol, order_ref=i)
+            for i, sub in enumerate(subs)
+        ])
+        db_session.commit()
+
+        engine = mock_get_engine()
+        statements = []
+        event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+        async def dispatch():
+            hub = NotificationHub(engine, poll_interval=60, heartbeat_interval=60)
+            queues = []
+            for sub in subs:
+                queues.append(hub.register(sub.connection_id))
+                hub.subscribe(sub.connection_id, sub.id)
+
+            await hub.dispatch()
+            assert len([statement for statement in statements if statement.startswith("UPDATE")]) == 1
+            assert not [statement for statement in statements if statement.startswith("SELECT")]
+            routed = [queue.get_nowait() for queue in queues]
+            assert [notification.message for notification in routed] == [sub.symbol for sub in subs]
+            assert all(notification.claimed_at and not notification.finished_at for notification in routed)
+
+            hub.stale = True
+            await hub.dispatch()
+            assert all(queue.empty() for queue in queues)
+
+            for notification in routed[1:]:
+                hub.ack(notification)
+            hub.release(routed[0])
+            hub.stale = True
+            statements.clear()
+            await hub.dispatch()
+            assert len(statements) == 3
+            assert queues[0].get_nowait().id == routed[0].id
+            hub.ack(routed[0])
+            assert not hub.inflight
+
+            statements.clear()
+            await hub.dispatch()
+            assert len(statements) == 1 and statements[0].startswith("UPDATE")
+            assert not hub.acked
+
+        asyncio.run(dispatch())
+        db_session.expire_all()
+        assert all(notification.finished_at for notification in db_session.query(Notification).all())
+        engine.dispose()
+
+    def test_notification_hub_gives_back_what_it_did_not_send_on_close(self, db_session):
+        """
+            Test if closing the notification hub makes the notifications it claimed and did not send pending again
+
+            Setup:
+            - Test database, a connection with a subscription and three pending notifications
+            - A running hub which claimed them: one is sent, one released and one still queued
+
+            Test:
+            - Once closed, the sent notification stays finished, the two others are pending again
+            - Nothing is left queued for the websocket
+        """
+        conn = Connection()
+        db_session.add(conn)
+        db_session.commit()
+        sub = Subscription(symbol=Symbol.BTCUSDT, connection_id=conn.id, price_threshold=1000)
+        db_session.add(sub)
+        db_session.commit()
+        db_session.add_all([
+            Notification(subscription_id=sub.id, symbol=sub.symbol, message=str(i), order_ref=i) for i in range(3)
+        ])
+        db_session.commit()
+
+        engine = mock_get_engine()
+
+        async def claim_and_close():
+            hub = NotificationHub(engine, poll_interval=60, heartbeat_interval=60)
+            queue = hub.register(conn.id)
+            hub.subscribe(conn.id, sub.id)
+            hub.start()
+            hub.wake("")
+            sent = await asyncio.wait_for(queue.get(), 5)
+            hub.ack(sent)
+            hub.release(queue.get_nowait())
+            await hub.close()
+            assert queue.empty()
+            assert not hub.inflight and not hub.released and not hub.acked
+            return sent
+
+        sent = asyncio.run(claim_and_close())
+        db_session.expire_all()
+        pending = {n.message for n in db_session.query(Notification)
+                   .filter(Notification.finished_at == None).filter(Notification.claimed_at == None)}
+        assert pending == {"0", "1", "2"} - {sent.message}
+        engine.dispose()
+
+    def test_notification_hub_claims_are_pending_again_when_their_lease_expires(self, db_session):
+        """
+            Test if the notifications claimed by a webserver worker that died are delivered by another one
+
+            Setup:
+            - Test database, a connection with a subscription and two pending notifications
+            - A hub which claims them and is never closed, like a killed worker, and a second hub
+
+            Test:
+            - The second hub claims nothing while the claims are leased
+            - Once the lease expired, the second hub claims and delivers both notifications
+        """
+        conn = Connection()
+        db_session.add(conn)
+        db_session.commit()
+        sub = Subscription(symbol=Symbol.BTCUSDT, connection_id=conn.id, price_threshold=1000)
+        db_session.add(sub)
+        db_session.commit()
+        db_session.add_all([
+            Notification(subscription_id=sub.id, symbol=sub.symbol, message=str(i), order_ref=i) for i in range(2)
+        ])
+        db_session.commit()
+
+        engine = mock_get_engine()
+
+        async def claim(hub: NotificationHub) -> list:
+            queue = hub.register(conn.id)
+            hub.subscribe(conn.id, sub.id)
+            await hub.dispatch()
+            routed = []
+            while not queue.empty():
+                routed.append(queue.get_nowait())
+            return routed
+
+        async def crash_and_recover():
+            dead = NotificationHub(engine, poll_interval=60, heartbeat_interval=60)
+            assert len(await claim(dead)) == 2
+
+            alive = NotificationHub(engine, poll_interval=60, heartbeat_interval=60)
+            assert await claim(alive) == []
+
+            db_session.execute(text("UPDATE notifications SET claimed_at = claimed_at - :lease"),
+                               {"lease": timedelta(seconds=NOTIFICATION_CLAIM_LEASE + 1)})
+            db_session.commit()
+            alive.stale = True
+            recovered = await claim(alive)
+            for notification in recovered:
+                alive.ack(notification)
+            await alive.dispatch()
+            return recovered
+
+        recovered = asyncio.run(crash_and_recover())
+        assert sorted(notification.message for notification in recovered) == ["0", "1"]
+        db_session.expire_all()
+        assert all(notification.finished_at for notification in db_session.query(Notification).all())
+        engine.dispose()
+
+    def test_notification_hubs_claim_concurrently_without_duplicates(self, db_session):
+        """
+            Test if several notification hubs, like the workers of several webserver replicas, split the notifications
+
+            Setup:
+            - Test database
+            - 2000 pending notifications of two subscriptions, routed by four hubs claiming 50 at a time
+
+            Test:
+            - The hubs claim concurrently, every notification is routed once and by one hub only
+            - A claim skips the rows locked by a claim not committed yet instead of waiting for it
+        """
+        conn = Connection()
+        db_session.add(conn)
+        db_session.commit()
+        subs = [Subscription(symbol=symbol, connection_id=conn.id, price_threshold=1000)
+                for symbol in (Symbol.BTCUSDT, Symbol.ETHUSDT)]
+        db_session.add_all(subs)
+        db_session.commit()
+        db_session.execute(text("""
+            INSERT INTO notifications (subscription_id, symbol, message, order_ref, created_at)
+            SELECT (:sub_ids)[1 + n % 2], 'btcusdt', 'Pending', n, timezone('utc', now())
+            FROM generate_series(1, 2000) n
+        """), {"sub_ids": [sub.id for sub in subs]})
+        db_session.commit()
+        ids = set(db_session.execute(text("SELECT id FROM notifications")).scalars().all())
+
+        engine = mock_get_engine()
+
+        async def consume(hub: NotificationHub) -> list:
+            queue = hub.register(conn.id)
+            for sub in subs:
+                hub.subscribe(conn.id, sub.id)
+            routed = []
+            while hub.stale:
+                await hub.dispatch()
+                while not queue.empty():
+                    notification = queue.get_nowait()
+                    hub.ack(notification)
+                    routed.append(notification.id)
+            return routed
+
+        async def consume_all():
+            hubs = [NotificationHub(engine, poll_interval=60, heartbeat_interval=60) for _ in range(4)]
+            return await asyncio.gather(*(consume(hub) for hub in hubs))
+
+        with mock.patch("hub.NOTIFICATION_CLAIM_BATCH", 50):
+            routed = asyncio.run(consume_all())
+        assert sorted(notification_id for of_hub in routed for notification_id in of_hub) == sorted(ids)
+        assert len([of_hub for of_hub in routed if of_hub]) > 1
+
+        db_session.execute(text("UPDATE notifications SET finished_at = NULL, claimed_at = NULL"))
+        db_session.commit()
+        with engine.connect() as first, engine.connect() as second:
+            with Session(bind=first) as holder, Session(bind=second) as claimer:
+                held = claim_pending_notifications(holder, [sub.id for sub in subs], limit=100)
+                claimer.execute(text("SET LOCAL lock_timeout = '1s'"))
+                claimed = claim_pending_notifications(claimer, [sub.id for sub in subs], limit=100)
+                assert len(held) == len(claimed) == 100
+                assert not {notification.id for notification in held} & {notification.id for notification in claimed}
+                claimer.rollback()
+                holder.rollback()
+        engine.dispose()
+
+    def test_notification_hub_heartbeats_every_subscription_at_once(self, db_session):
+        """
+            Test if the notification hub heartbeats the subscriptions of all its connections with one UPDATE
+
+            Setup:
+            - Test database
+            - Two connections of one hub: a live subscription, a finished one and an expired one
+
+            Test:
+            - A single statement heartbeats the live subscription
+            - The finished and the expired subscriptions are left as they are
+        """
+        stale = datetime.utcnow() - timedelta(seconds=HEARTBEAT_LIMIT / 2)
+        expired = datetime.utcnow() - timedelta(seconds=HEARTBEAT_LIMIT * 2)
+        conns = [Connection(), Connection()]
+        db_session.add_all(conns)
+        db_session.commit()
+        live, finished, dead = (
+            Subscription(symbol=Symbol.BTCUSDT, connection_id=conns[0].id, price_threshold=1000, last_heartbeat=stale),
+            Subscription(symbol=Symbol.ETHUSDT, connection_id=conns[0].id, price_threshold=1000, last_heartbeat=stale,
+                         finished_at=datetime.utcnow()),
+            Subscription(symbol=Symbol.ETHBTC, connection_id=conns[1].id, price_threshold=1000, last_heartbeat=expired),
+        )
+        db_session.add_all([live, finished, dead])
+        db_session.commit()
+
+        engine = mock_get_engine()
+        statements = []
+        event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+        async def heartbeat():
+            hub = NotificationHub(engine, poll_interval=60, heartbeat_interval=60)
+            for sub in (live, finished, dead):
+                hub.register(sub.connection_id)
+                hub.subscribe(sub.connection_id, sub.id)
+            await hub.heartbeat()
+            assert len([statement for statement in statements if statement.startswith("UPDATE")]) == 1
+
+        asyncio.run(heartbeat())
+        db_session.expire_all()
+        assert db_session.get(Subscription, live.id).last_heartbeat > stale
+        assert db_session.get(Subscription, finished.id).last_heartbeat == stale
+        assert db_session.get(Subscription, dead.id).last_heartbeat == expired
+        engine.dispose()
 
 
 class TestWsServerFunctionally:
@@ -252,10 +1343,8 @@ class TestWsServerFunctionally:
             - Subscribe and see Subscriptions being created into the database
         """
         caplog.set_level(logging.DEBUG)
-        client = TestClient(app)
-
         assert len(db_session.query(Connection).all()) == 0
-        with client.websocket_connect("/ws") as websocket:
+        with TestClient(app) as client, client.websocket_connect("/ws") as websocket:
             time.sleep(0.1)
             assert len(db_session.query(Connection).all()) == 1
             assert len(db_session.query(Subscription).all()) == 0
@@ -268,6 +1357,101 @@ class TestWsServerFunctionally:
             websocket.receive_text()
             assert len(db_session.query(Subscription).all()) == 2
 
+    def test_ws_server_exposes_metrics(self, db_session):
+        """
+            Test if WsServer exposes its Prometheus metrics
+
+            Setup:
+            - Test database
+            - Mock WsServer simulating a run
+
+            Test:
+            - /metrics counts the open websocket connections
+            - Subscribing checks connections out of the instrumented database pool
+        """
+        with TestClient(app) as client:
+            def sample(name):
+                for line in client.get("/metrics").text.splitlines():
+                    if line.startswith(f"{name} "):
+                        return float(line.split()[1])
+
+            websockets_before = sample("webserver_websockets_active")
+            checkouts_before = sample("db_pool_checkouts_total")
+            with client.websocket_connect("/ws") as websocket:
+                websocket.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
+                websocket.receive_text()
+
+                assert sample("webserver_websockets_active") == websockets_before + 1
+                assert sample("db_pool_checkouts_total") > checkouts_before
+
+            time.sleep(0.1)
+            assert sample("webserver_websockets_active") == websockets_before
+
+    def test_ws_server_shares_one_engine(self, db_session):
+        """
+            Test if WsServer injects the engine of the worker into every websocket
+
+            Setup:
+            - Test database
+            - Mock WsServer simulating a run
+
+            Test:
+            - Two websockets get the engine created at startup
+            - /metrics exposes the size and the usage of its pool
+        """
+        with TestClient(app) as client, mock.patch.object(main, "WsHandler", wraps=main.WsHandler) as handler:
+            with client.websocket_connect("/ws") as first, client.websocket_connect("/ws") as second:
+                for websocket in (first, second):
+                    websocket.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
+                    websocket.receive_text()
+
+                engines = [call.args[1] for call in handler.call_args_list]
+                assert engines == [app.state.engine, app.state.engine]
+
+                metrics = client.get("/metrics").text
+                assert f"db_pool_size {float(main.DB_POOL_SIZE)}" in metrics
+                assert "db_pool_checked_out " in metrics
+
+    def test_ws_server_queries_off_the_event_loop(self, db_session):
+        """
+            Test if WsServer keeps its event loop running while the database is slow
+
+            Setup:
+            - Test database, every statement of the webserver 0.2 seconds slower
+            - A websocket handler and its hub
+
+            Test:
+            - Registering the connection, subscribing, dispatching and heartbeating never stall the loop
+        """
+        engine = mock_get_engine()
+        event.listen(engine, "before_cursor_execute", lambda *args: time.sleep(0.2))
+        lags = []
+
+        async def probe():
+            loop = asyncio.get_running_loop()
+            while True:
+                start = loop.time()
+                await asyncio.sleep(0.01)
+                lags.append(loop.time() - start - 0.01)
+
+        async def serve():
+            hub = NotificationHub(engine, poll_interval=60, heartbeat_interval=60)
+            handler = main.WsHandler(mock.AsyncMock(), engine, hub)
+            probing = asyncio.create_task(probe())
+            await handler.open()
+            res = await handler.handle_received_message(mock_subscription_message(Symbol.BTCUSDT, 1000))
+            await hub.dispatch()
+            await hub.heartbeat()
+            probing.cancel()
+            return res
+
+        res = asyncio.run(serve())
+        assert res["symbol"] == Symbol.BTCUSDT
+        assert len(db_session.query(Subscription).all()) == 1
+        assert len(lags) > 20
+        assert max(lags) < 0.1
+        engine.dispose()
+
     def test_ws_server_can_handle_notifications(self, db_session, caplog):
         """
             Test if WsServer can handle notifications
@@ -282,10 +1466,8 @@ class TestWsServerFunctionally:
             - Create a mock Notification on the database and check the message on websocket prompt
         """
         caplog.set_level(logging.DEBUG)
-        client = TestClient(app)
-
         assert len(db_session.query(Connection).all()) == 0
-        with client.websocket_connect("/ws") as websocket:
+        with TestClient(app) as client, client.websocket_connect("/ws") as websocket:
             websocket.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
             websocket.receive_text()
 
@@ -306,10 +1488,73 @@ class TestWsServerFunctionally:
             db_session.commit()
 
             res = json.loads(websocket.receive_text())
-            assert res["subscription_id"] == btc_sub.id
+            assert res["subscription_id"] == str(btc_sub.id)
             assert res["symbol"] == btc_sub.symbol
             assert res["message"] == "Mock message"
 
+    def test_ws_server_closes_the_session_when_sending_fails(self, db_session):
+        """
+            Test if WsServer ends the connection and its subscriptions when a notification can't be sent
+
+            Setup:
+            - Test database
+            - Sending notifications fails, as on a connection lost meanwhile
+
+            Test:
+            - The connection and its subscriptions are finished
+            - The notification is pending again, for a later delivery
+        """
+        async def failing_send(handler, notification):
+            handler.hub.release(notification)
+            raise RuntimeError("Connection lost")
+
+        with mock.patch.object(main.WsHandler, "send_notifications", new=failing_send), \
+                TestClient(app) as client, client.websocket_connect("/ws") as websocket:
+            websocket.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
+            websocket.receive_text()
+            sub = db_session.query(Subscription).one()
+
+            notification = Notification(subscription_id=sub.id, symbol=sub.symbol, message="Mock message", order_ref=1)
+            db_session.add(notification)
+            db_session.commit()
+
+            for _ in range(50):
+                db_session.expire_all()
+                if sub.finished_at is not None:
+                    break
+                time.sleep(0.1)
+
+        assert sub.finished_at is not None
+        assert db_session.query(Connection).one().finished_at is not None
+        db_session.expire_all()
+        assert notification.finished_at is None and notification.claimed_at is None
+
+    def test_ws_server_is_woken_up_by_notify(self, db_session):
+        """
+            Test if WsServer delivers the notifications as soon as they are inserted, without polling
+
+            Setup:
+            - Test database
+            - Mock WsServer simulating a run, with a safety net poll out of reach
+
+            Test:
+            - A notification inserted into the database reaches the websocket right away, through LISTEN/NOTIFY
+        """
+        with mock.patch.object(main, "NOTIFICATION_POLL_INTERVAL", 60), \
+                TestClient(app) as client, client.websocket_connect("/ws") as websocket:
+            websocket.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
+            websocket.receive_text()
+            btc_sub = db_session.query(Subscription).all()[0]
+
+            start = time.monotonic()
+            db_session.add(Notification(subscription_id=btc_sub.id, symbol=btc_sub.symbol, message="Mock message",
+                                        order_ref=random.randint(0, 1000000)))
+            db_session.commit()
+
+            res = json.loads(websocket.receive_text())
+            assert res["subscription_id"] == str(btc_sub.id)
+            assert time.monotonic() - start < 1
+
     def test_ws_server_cannot_subscribe_into_invalid_symbol(self, db_session, caplog):
         """
             Test if WsServer throw error when trying to subscribe into an invalid symbol
@@ -323,10 +1568,8 @@ class TestWsServerFunctionally:
             - Subscribe and see Subscriptions being created into the database
         """
         caplog.set_level(logging.DEBUG)
-        client = TestClient(app)
-
         assert len(db_session.query(Connection).all()) == 0
-        with client.websocket_connect("/ws") as websocket:
+        with TestClient(app) as client, client.websocket_connect("/ws") as websocket:
             time.sleep(0.1)
             assert len(db_session.query(Connection).all()) == 1
             assert len(db_session.query(Subscription).all()) == 0
@@ -349,10 +1592,9 @@ class TestWsServerFunctionally:
             - Subscribe and see Subscriptions being created into the database
         """
         caplog.set_level(logging.DEBUG)
-        client = TestClient(app)
-
         assert len(db_session.query(Connection).all()) == 0
-        with client.websocket_connect("/ws") as w1, client.websocket_connect("/ws") as w2:
+        with TestClient(app) as client, \
+                client.websocket_connect("/ws") as w1, client.websocket_connect("/ws") as w2:
             w1.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
             w1.receive_text()
 
@@ -380,7 +1622,7 @@ class TestWsServerFunctionally:
             db_session.commit()
 
             res = json.loads(w1.receive_text())
-            assert res["subscription_id"] == w1_sub.id
+            assert res["subscription_id"] == str(w1_sub.id)
             assert res["symbol"] == w1_sub.symbol
             assert res["message"] == "Mock message"
 
@@ -395,6 +1637,7 @@ class TestMockE2EIngestionAndWsServer:
             Setup:
             - Test database
             - Mock WebSocketApp client simulating an actual run of the Ingestion
+              - running into a different thread, frames are handed to its event loop
               - on_open will run as well as the periodic background actions
               - it needs some time to run the background actions in order to replace the symbols to subscribe
             - Mock WsServer simulating a run
@@ -408,38 +1651,48 @@ class TestMockE2EIngestionAndWsServer:
             database
             - WsServer can read the Notification rows and send the messages to the respective websocket connections
         """
-        client = TestClient(app)
         assert len(db_session.query(Connection).all()) == 0
-        with mock_websocketapp(), client.websocket_connect("/ws") as websocket:
+        with mock_websocketapp(keep_open=True), TestClient(app) as client, \
+                client.websocket_connect("/ws") as websocket:
             time.sleep(0.1)
             assert len(db_session.query(Connection).all()) == 1
 
             ingestion = TestIngestion()
-            ws = ingestion.run()
-            time.sleep(1)
-
-            assert ingestion.symbol_subs == set()
-
-            websocket.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
-            websocket.receive_text()
-
-            # Wait to the ingestion work
-            time.sleep(1)
-
-            subscriptions = db_session.query(Subscription).all()
-            assert len(subscriptions) == 1
-            assert ingestion.symbol_subs == {Symbol.BTCUSDT}
-
-            # pricing going down - do not send any notification - from 1100 to 900
-            ws.on_message(ws, mock_trade_message(Symbol.BTCUSDT, 1100.00))
-            ws.on_message(ws, mock_trade_message(Symbol.BTCUSDT, 900.00))
-            assert len(db_session.query(Notification).all()) == 0
-
-            # pricing going up - do send a notification - from 900 to 1100
-            ws.on_message(ws, mock_trade_message(Symbol.BTCUSDT, 1100.00))
-            notifications = db_session.query(Notification).all()
-            assert len(notifications) == 1
-
-            message = websocket.receive_text()
-            message = json.loads(message)
-            assert message["subscription_id"] == subscriptions[0].id
+            with serving(ingestion, 1):
+                ws = ingestion.streams.connections[0]
+
+                assert ingestion.symbol_subs == set()
+
+                websocket.send_text(mock_subscription_message(symbol=Symbol.BTCUSDT, threshold=1000))
+                websocket.receive_text()
+
+                # Wait to the ingestion work
+                time.sleep(1)
+
+                subscriptions = db_session.query(Subscription).all()
+                assert len(subscriptions) == 1
+                assert ingestion.symbol_subs == {Symbol.BTCUSDT}
+
+                # pricing going down - do not send any notification - from 1100 to 900
+                run_on_loop(ingestion, ws.on_message, ws, mock_trade_message(Symbol.BTCUSDT, 1100.00))
+                run_on_loop(ingestion, ws.on_message, ws, mock_trade_message(Symbol.BTCUSDT, 900.00))
+                run_on_loop(ingestion, ingestion.flush)
+                assert len(db_session.query(Notification).all()) == 0
+
+                delivered = REGISTRY.get_sample_value("alert_latency_seconds_count", {"stage": "delivery"}) or 0
+
+                # pricing going up - do send a notification - from 900 to 1100
+                run_on_loop(ingestion, ws.on_message, ws, mock_trade_message(Symbol.BTCUSDT, 1100.00))
+                run_on_loop(ingestion, ingestion.flush)
+                notifications = db_session.query(Notification).all()
+                assert len(notifications) == 1
+                # Every stage of the alert is timestamped
+                assert notifications[0].event_at is not None
+                assert notifications[0].received_at <= notifications[0].detected_at <= notifications[0].created_at
+
+                message = websocket.receive_text()
+                message = json.loads(message)
+                assert message["subscription_id"] == str(subscriptions[0].id)
+                # Observed right after the send
+                time.sleep(0.1)
+                assert REGISTRY.get_sample_value("alert_latency_seconds_count", {"stage": "delivery"}) == delivered + 1
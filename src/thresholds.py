@@ -0,0 +1,102 @@
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class ThresholdIndex:
+    """
+        Sorted price thresholds per symbol, used to find which subscriptions a price move has crossed.
+
+        Thresholds and subscription ids live in two parallel lists ordered by threshold, so a rise from
+        `previous_price` to `current_price` is resolved with two binary searches: O(log n + k).
+    """
+
+    def __init__(self) -> None:
+        self.thresholds: Dict[str, List[float]] = {}
+        self.sub_ids: Dict[str, List[int]] = {}
+        # sub_id -> (symbol, threshold), needed to find an entry back when removing it.
+        self.locations: Dict[int, Tuple[str, float]] = {}
+        # NumPy copies of the thresholds for `crossings`, dropped whenever the symbol changes.
+        self.arrays: Dict[str, "np.ndarray"] = {}
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def __contains__(self, sub_id: int) -> bool:
+        return sub_id in self.locations
+
+    def add(self, sub_id: int, symbol: str, threshold: float):
+        if sub_id in self.locations:
+            return
+
+        thresholds = self.thresholds.setdefault(symbol, [])
+        sub_ids = self.sub_ids.setdefault(symbol, [])
+        position = bisect_right(thresholds, threshold)
+        thresholds.insert(position, threshold)
+        sub_ids.insert(position, sub_id)
+        self.locations[sub_id] = (symbol, threshold)
+        self.arrays.pop(symbol, None)
+
+    def remove(self, sub_id: int):
+        location = self.locations.pop(sub_id, None)
+        if location is None:
+            return
+
+        symbol, threshold = location
+        thresholds = self.thresholds[symbol]
+        sub_ids = self.sub_ids[symbol]
+        position = bisect_left(thresholds, threshold)
+        # Several subscriptions may share the same threshold
+        while sub_ids[position] != sub_id:
+            position += 1
+        del thresholds[position]
+        del sub_ids[position]
+        self.arrays.pop(symbol, None)
+
+        if not thresholds:
+            del self.thresholds[symbol]
+            del self.sub_ids[symbol]
+
+    def symbols(self) -> Set[str]:
+        return set(self.thresholds)
+
+    def crossed(self, symbol: str, previous_price: float, current_price: float) -> List[int]:
+        """Subscription ids whose threshold lies strictly between previous_price and a higher current_price."""
+        thresholds = self.thresholds.get(symbol)
+        if not thresholds or current_price <= previous_price:
+            return []
+
+        start = bisect_right(thresholds, previous_price)
+        end = bisect_left(thresholds, current_price, start)
+        return self.sub_ids[symbol][start:end]
+
+    def crossings(self, symbol: str, previous_price: Optional[float],
+                  prices: Sequence[float]) -> List[Tuple[int, List[int]]]:
+        """
+            `crossed` over a run of consecutive prices of a symbol, vectorized with NumPy.
+
+            Returns (index in prices, subscription ids) for every rise of the run that crossed a threshold, in the
+            order calling `crossed` price after price would find them. The run starts from previous_price, if any.
+        """
+        if symbol not in self.thresholds or not len(prices):
+            return []
+        thresholds = self.arrays.get(symbol)
+        if thresholds is None:
+            thresholds = self.arrays[symbol] = np.array(self.thresholds[symbol], dtype=float)
+
+        prices = np.asarray(prices, dtype=float)
+        starts = np.empty_like(prices)
+        starts[0] = previous_price or 0
+        starts[1:] = prices[:-1]
+        # No previous price, no rise: same as `if previous_price and ...` on the scalar path
+        starts[starts == 0] = np.inf
+
+        rising = np.flatnonzero(starts < prices)
+        lows = np.searchsorted(thresholds, starts[rising], side="right")
+        highs = np.searchsorted(thresholds, prices[rising], side="left")
+        sub_ids = self.sub_ids[symbol]
+        return [(int(rising[i]), sub_ids[lows[i]:highs[i]]) for i in np.flatnonzero(lows < highs)]
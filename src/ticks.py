@@ -0,0 +1,101 @@
+from os import environ
+import asyncio
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from metrics import TICKS_COALESCED
+
+# Trades of one symbol waiting for evaluation before they get coalesced, when the ingestion doesn't vectorize. An
+# upstream connection hands over at most 32 frames (websockets' max_queue) before the evaluation task gets its turn,
+# a symbol only gets past this in a burst.
+TICK_QUEUE_SYMBOL_SIZE = int(environ.get("TICK_QUEUE_SYMBOL_SIZE", 16))
+
+
+class Tick(NamedTuple):
+    price: float
+    # Binance event time, in milliseconds
+    event_time: int
+    # Receipt time of the frame, in seconds since the epoch
+    received_at: float
+
+
+def coalesce(ticks: List[Tick]) -> List[Tick]:
+    """
+        Shrinks a run of trades of one symbol to at most [first, low, high, last].
+
+        low is the lowest price a rise started from and high the highest price a rise reached, so every threshold
+        crossed upwards inside the run lies between them: evaluating low -> high misses none. A threshold crossed
+        several times is reported once, and one only traversed downwards between two rises may be reported too.
+        first >= low and high >= last, so no other rise is made up and the last price stays the last one.
+    """
+    low = high = None
+    for previous, tick in zip(ticks, ticks[1:]):
+        if previous.price < tick.price:
+            if low is None or previous.price < low.price:
+                low = previous
+            if high is None or tick.price > high.price:
+                high = tick
+
+    coalesced = [ticks[0]]
+    for tick in (low, high, ticks[-1]):
+        if tick is not None and tick is not coalesced[-1]:
+            coalesced.append(tick)
+    return coalesced
+
+
+class TickQueue:
+    """
+        Trades between their receipt and their evaluation, grouped by symbol.
+
+        Bounded by `size` trades per symbol: past it, the pending trades of the symbol are handed to `evaluate`
+        right away when given, and coalesced otherwise instead of dropped, see `coalesce`. The queue is drained by
+        every round of the evaluation task, so the bound applies to what a symbol receives between two rounds,
+        whatever the number of symbols.
+    """
+
+    def __init__(self, size: int = TICK_QUEUE_SYMBOL_SIZE,
+                 evaluate: Optional[Callable[[str, List[Tick]], None]] = None) -> None:
+        self.size = size
+        self.evaluate = evaluate
+        self.pending: Dict[str, List[Tick]] = {}
+        self.depth = 0
+        # Created by the evaluation task, on the loop it belongs to.
+        self.ready: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return self.depth
+
+    def put(self, symbol: str, tick: Tick):
+        ticks = self.pending.get(symbol)
+        if ticks is None:
+            ticks = self.pending[symbol] = []
+        ticks.append(tick)
+        self.depth += 1
+
+        if len(ticks) > self.size:
+            if self.evaluate is not None:
+                self.hand_over(symbol)
+            else:
+                self.coalesce(symbol)
+        if self.ready is not None:
+            self.ready.set()
+
+    def coalesce(self, symbol: str):
+        ticks = self.pending[symbol]
+        if len(ticks) <= 4:
+            return
+        coalesced = self.pending[symbol] = coalesce(ticks)
+        self.depth -= len(ticks) - len(coalesced)
+        TICKS_COALESCED.inc(len(ticks) - len(coalesced))
+
+    def hand_over(self, symbol: str):
+        ticks = self.pending.pop(symbol)
+        self.depth -= len(ticks)
+        self.evaluate(symbol, ticks)
+
+    def drain(self) -> List[Tuple[str, List[Tick]]]:
+        pending = list(self.pending.items())
+        self.pending = {}
+        self.depth = 0
+        if self.ready is not None:
+            self.ready.clear()
+        return pending
@@ -0,0 +1,154 @@
+from os import environ
+import asyncio
+from concurrent.futures import Executor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+
+from sql.models import Notification
+from metrics import ALERT_LATENCY, NOTIFICATIONS_INSERTED, NOTIFICATIONS_DROPPED
+from logger.logger import logging, debug_enabled
+import serialization
+
+NOTIFICATION_BATCH_SIZE = int(environ.get("NOTIFICATION_BATCH_SIZE", 500))
+NOTIFICATION_FLUSH_INTERVAL = float(environ.get("NOTIFICATION_FLUSH_INTERVAL", 0.05))
+NOTIFICATION_BUFFER_SIZE = int(environ.get("NOTIFICATION_BUFFER_SIZE", 100000))
+# Attempts of a batch that failed to be written before it is dropped, waiting twice as long after each failure.
+NOTIFICATION_WRITE_RETRIES = int(environ.get("NOTIFICATION_WRITE_RETRIES", 3))
+
+
+class NotificationWriter:
+    """
+        Writes the notifications in batches, so evaluating a frame never waits on the database.
+
+        Notifications are plain dicts of the `notifications` columns. They are buffered and inserted with one
+        multi-row Core INSERT, once NOTIFICATION_BATCH_SIZE rows are pending or NOTIFICATION_FLUSH_INTERVAL
+        seconds after the first one arrived. `run` is the flushing task of the ingestion event loop, the INSERT
+        itself runs on the given executor. No ORM session is involved.
+
+        The buffer holds NOTIFICATION_BUFFER_SIZE rows at most. Evaluation runs on the same loop as the writer task
+        and can't wait for it, so past the bound new notifications are dropped and counted. The saturation is logged
+        when it starts, and again once the buffer is back to half of its size.
+
+        A failed batch is put back in front of the buffer and retried NOTIFICATION_WRITE_RETRIES times, then dropped.
+    """
+
+    def __init__(self, engine: Engine, batch_size: int = NOTIFICATION_BATCH_SIZE,
+                 flush_interval: float = NOTIFICATION_FLUSH_INTERVAL,
+                 buffer_size: int = NOTIFICATION_BUFFER_SIZE, retries: int = NOTIFICATION_WRITE_RETRIES) -> None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.retries = retries
+        self.buffer: List[Dict] = []
+        # Consecutive failed writes
+        self.failures = 0
+        # Notifications dropped since the buffer got full, None while it has room
+        self.dropped: Optional[int] = None
+        # Created by run, on the loop they belong to.
+        self.pending: Optional[asyncio.Event] = None
+        self.filled: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def put(self, notifications: List[Dict]):
+        room = max(self.buffer_size - len(self.buffer), 0)
+        if len(notifications) > room:
+            self.drop(len(notifications) - room)
+            notifications = notifications[:room]
+        self.buffer.extend(notifications)
+
+        if self.pending is not None:
+            self.pending.set()
+            # A full buffer doesn't wait for the batch to fill up either, the writer task catches up.
+            if len(self.buffer) >= self.batch_size:
+                self.filled.set()
+
+    async def run(self, executor: Executor):
+        loop = asyncio.get_running_loop()
+        self.pending = asyncio.Event()
+        self.filled = asyncio.Event()
+        if self.buffer:
+            self.pending.set()
+
+        try:
+            while True:
+                await self.pending.wait()
+                try:
+                    # Give the batch a chance to fill up
+                    await asyncio.wait_for(self.filled.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                batch = self.take()
+                if len(self.buffer) < self.batch_size:
+                    self.filled.clear()
+                if not self.buffer:
+                    self.pending.clear()
+                if not batch:
+                    continue
+                if await loop.run_in_executor(executor, self.write, batch):
+                    self.failures = 0
+                else:
+                    await self.retry(batch)
+        finally:
+            self.pending = None
+            self.filled = None
+
+    def drop(self, count: int):
+        NOTIFICATIONS_DROPPED.inc(count)
+        if self.dropped is None:
+            self.dropped = 0
+            logging.warning(f"Notification buffer is full ({self.buffer_size} rows), dropping the new notifications")
+        self.dropped += count
+
+    def take(self) -> List[Dict]:
+        batch = self.buffer[:self.batch_size]
+        del self.buffer[:self.batch_size]
+        if self.dropped is not None and len(self.buffer) <= self.buffer_size // 2:
+            logging.warning(f"Notification buffer has room again, {self.dropped} notifications were dropped")
+            self.dropped = None
+        return batch
+
+    async def retry(self, batch: List[Dict]):
+        self.failures += 1
+        if self.failures > self.retries or len(self.buffer) + len(batch) > self.buffer_size:
+            logging.error(f"Dropping {len(batch)} notifications after {self.failures} failed writes")
+            NOTIFICATIONS_DROPPED.inc(len(batch))
+            self.failures = 0
+            return
+
+        self.buffer[:0] = batch
+        self.pending.set()
+        await asyncio.sleep(self.flush_interval * 2 ** self.failures)
+
+    def write(self, batch: List[Dict]) -> bool:
+        """Inserts the batch, False when it could not be written."""
+        try:
+            # ids and created_at come from the column defaults, evaluated for each row.
+            with self.engine.begin() as connection:
+                connection.execute(insert(Notification.__table__), batch)
+        except Exception as e:
+            logging.error(f"Could not write {len(batch)} notifications: {e}")
+            return False
+
+        committed_at = datetime.utcnow()
+        NOTIFICATIONS_INSERTED.inc(len(batch))
+        commit = ALERT_LATENCY.labels("commit")
+        for row in batch:
+            if "detected_at" in row:
+                commit.observe((committed_at - row["detected_at"]).total_seconds())
+        logging.info(f"publish {len(batch)} notifications")
+        if debug_enabled():
+            # The rows hold datetimes, which the standard library json can't serialize by itself
+            logging.debug(f"notifications: {serialization.dumps(batch, default=str)}")
+        return True
+
+    def flush(self):
+        """Writes every pending notification right away, from the calling thread."""
+        while self.buffer:
+            self.write(self.take())